@@ -1,76 +1,553 @@
 import asyncio
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
 import csv
 import datetime
+import fcntl
+import hashlib
+import json
+import mimetypes
+import multiprocessing
 import os
 import pathlib
 import re
 import shutil
-import subprocess
+import sqlite3
 import sys
+import threading
+import time
+import urllib.parse
 import zipfile
+import zlib
 
 from playwright.async_api import async_playwright, TimeoutError, Error
 
-TAKEOUT_BASEURL = "https://takeout.google.com/"
+TAKEOUT_BASEURL = os.getenv("TAKEOUT_BASEURL", "https://takeout.google.com/")
 BACKUP_FRESHNESS_INTERVAL = datetime.timedelta(
     hours=int(os.getenv("BACKUP_FRESHNESS_THRESHOLD_HOURS", "12"))
 )
 TIMEOUT_MILLIS = int(os.getenv("TIMEOUT_MILLIS", "30000"))
+ARCHIVE_PROBE_CONCURRENCY = max(1, int(os.getenv("ARCHIVE_PROBE_CONCURRENCY", "3")))
+REAUTH_DETECT_MILLIS = int(os.getenv("REAUTH_DETECT_MILLIS", "3000"))
+REAUTH_URL_PREFIXES = {
+    "account.chooser": "https://accounts.google.com/v3/signin/accountchooser",
+    "home.address": "https://gds.google.com/web/homeaddress",
+    "password.challenge": "https://accounts.google.com/v3/signin/challenge/pwd",
+}
+DOWNLOAD_CONCURRENCY = max(1, int(os.getenv("DOWNLOAD_CONCURRENCY", "1")))
+# stream - write parts as they arrive from the browser hashing them on the way, relies on playwright internals,
+# save_as - let playwright save parts, what stream falls back to,
+# shared - move parts from the browser downloads dir mounted to BROWSER_DOWNLOADS_PATH
+DOWNLOAD_MODES = ["stream", "save_as", "shared"]
+DOWNLOAD_MODE = os.getenv("DOWNLOAD_MODE", "stream")
+BROWSER_DOWNLOADS_PATH = os.getenv("BROWSER_DOWNLOADS_PATH")
+DOWNLOAD_STREAM_CHUNK_SIZE = 2**23
+PIPELINED_EXTRACTION = os.getenv("PIPELINED_EXTRACTION", "false").lower() == "true"
+DELETE_EXTRACTED_PARTS = os.getenv("DELETE_EXTRACTED_PARTS", "false").lower() == "true"
+EXTRACTION_WORKERS = max(1, int(os.getenv("EXTRACTION_WORKERS") or os.cpu_count() or 1))
+EXTRACTION_BUFFER_SIZE = 2**20
+PROCESSING_WORKERS = max(1, int(os.getenv("PROCESSING_WORKERS") or os.cpu_count() or 1))
+PROCESSING_BATCH_SIZE = 1024
+PROCESSING_DRY_RUN = os.getenv("PROCESSING_DRY_RUN", "false").lower() == "true"
+DEDUP_STORE = os.getenv("DEDUP_STORE", "false").lower() == "true"
+DEDUP_LINK = os.getenv("DEDUP_LINK", "hardlink")
+DELTA_MODE = os.getenv("DELTA_MODE", "false").lower() == "true"
+FICLONE = 0x40049409
+ACCOUNTS_CONFIG = os.getenv("ACCOUNTS_CONFIG")
+# unset means DOWNLOAD_CONCURRENCY per account
+TOTAL_DOWNLOAD_CONCURRENCY = int(os.getenv("TOTAL_DOWNLOAD_CONCURRENCY") or 0)
+DISK_BANDWIDTH = float(os.getenv("DISK_BANDWIDTH_MB", "0")) * 2**20
+ARCHIVE_PART_SIZE = float(os.getenv("ARCHIVE_PART_SIZE_GB", "2")) * 2**30
+# room for album-only copies, sidecars and estimate errors
+DISK_SPACE_MARGIN = 0.05
+SIZE_UNITS = {"KB": 2**10, "КБ": 2**10, "MB": 2**20, "МБ": 2**20, "GB": 2**30, "ГБ": 2**30}
+SIZE_PATTERN = re.compile(rf"(\d+(?:[.,]\d+)?)\s*({"|".join(SIZE_UNITS)})", re.IGNORECASE)
+PROMETHEUS_TEXTFILE = os.getenv("PROMETHEUS_TEXTFILE")
+RUN_REPORTS_KEEP = 100
+CAPTURE_BUFFER_SIZE = int(os.getenv("CAPTURE_BUFFER_SIZE", "1000"))
+# all - every request and response, filtered - failures and CAPTURE_DOMAINS traffic, off - no network capture
+CAPTURE_NETWORK = os.getenv("CAPTURE_NETWORK", "filtered")
+CAPTURE_DOMAINS = tuple(
+    os.getenv("CAPTURE_DOMAINS", "takeout.google.com,accounts.google.com").split(",")
+)
+
+
+account_name = contextvars.ContextVar("account_name", default=None)
 
 
 class EarlyReturn(Exception):
     pass
 
 
-auth_json_path = pathlib.Path(".auth_encoded")
+class ExtractionError(Exception):
+    pass
+
+
+class InsufficientSpaceError(Exception):
+    pass
+
+
+class ArchiveManifest:
+    """Download and processing state of one archive, stored next to its download dir to resume failed runs"""
+
+    def __init__(self, path: pathlib.Path, archive_id):
+        self.path = path
+        if path.exists():
+            self.data = json.loads(path.read_text())
+        else:
+            self.data = {"archive": archive_id, "parts": {}, "stages": []}
+
+    def part(self, i):
+        return self.data["parts"].get(str(i), {"state": "pending"})
+
+    def parts(self):
+        return sorted(self.data["parts"].items(), key=lambda item: int(item[0]))
+
+    def is_downloaded(self, i, target_path: pathlib.Path):
+        part = self.part(i)
+        if part["state"] == "pending":
+            return False
+        if part["state"] != "downloaded":
+            return True
+        part_path = target_path.joinpath(part["filename"])
+        return part_path.exists() and part_path.stat().st_size == part["size"]
+
+    def update_part(self, i, **fields):
+        self.data["parts"].setdefault(str(i), {"state": "pending"}).update(fields)
+        self.save()
+
+    def has_stage(self, stage):
+        return stage in self.data["stages"]
+
+    def complete_stage(self, stage):
+        self.data["stages"].append(stage)
+        self.save()
+
+    def save(self):
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        tmp_path.write_text(json.dumps(self.data, indent=2))
+        tmp_path.replace(self.path)
+
+
+class BackupAccount:
+    """Credentials and storage of one backed up account"""
+
+    def __init__(
+        self,
+        name,
+        auth_json_path: pathlib.Path,
+        downloads_path: pathlib.Path,
+        backup_path: pathlib.Path,
+        encoded_pass,
+        browser_url,
+    ):
+        self.name = name
+        self.auth_json_path = auth_json_path
+        self.downloads_path = downloads_path
+        self.backup_path = backup_path
+        self.timestamp_path = backup_path.joinpath(".timestamp")
+        self.index_path = backup_path.joinpath(".index.sqlite")
+        self.blobs_path = backup_path.joinpath(".blobs")
+        self.archive_timestamps_path = backup_path.joinpath(".archive-timestamps.json")
+        self.reports_path = downloads_path.joinpath("reports")
+        self.encoded_pass = encoded_pass
+        self.browser_url = browser_url
+        self.reauth_counter = collections.Counter()
+
+
+class BandwidthLimiter:
+    """Token bucket capping bytes per second with a second worth of burst, shared by threads of a process"""
+
+    def __init__(self, bytes_per_second):
+        self.rate = bytes_per_second
+        self.lock = threading.Lock()
+        self.available_at = time.monotonic()
+
+    def throttle(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.available_at = max(self.available_at, now - 1) + size / self.rate
+            delay = self.available_at - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SharedLimits:
+    """Resources shared by concurrently running accounts"""
+
+    def __init__(self, download_concurrency, extraction_workers, disk_bandwidth):
+        self.download_slots = asyncio.Semaphore(download_concurrency)
+        self.extraction_workers = extraction_workers
+        self.extraction_pool = concurrent.futures.ProcessPoolExecutor(
+            extraction_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        # processing pool takes all PROCESSING_WORKERS, so archives are processed one at a time
+        self.processing_lock = asyncio.Lock()
+        # worker processes can't share a bucket, so each of them and the merge get a static share
+        disk_share = disk_bandwidth / (extraction_workers + 1)
+        self.extraction_bandwidth = disk_share
+        self.merge_bandwidth = BandwidthLimiter(disk_share)
+
+
+class AccountPrefixedOutput:
+    """Prefixes output lines with the account printing them to tell concurrent runs apart"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        if name := account_name.get():
+            text = "".join(
+                f"[{name}] {line}" if line.strip() else line
+                for line in text.splitlines(keepends=True)
+            )
+        return self.stream.write(text)
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+
+class RunMetrics:
+    """Wall time and counters of bytes, files, retries and so on by stage of one account run"""
+
+    def __init__(self, account: BackupAccount):
+        self.account = account.name or "default"
+        self.started_at = time.time()
+        self.seconds = 0
+        self.status = "running"
+        self.detail = None
+        self.error = None
+        self.reauth = account.reauth_counter
+        self.stages = collections.defaultdict(collections.Counter)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Adds wall time of the block to the stage, yields stage counters to be updated"""
+        started_at = time.monotonic()
+        try:
+            yield self.stages[name]
+        finally:
+            self.stages[name]["seconds"] += time.monotonic() - started_at
+
+    def report(self):
+        return {
+            "account": self.account,
+            "started_at": datetime.datetime.fromtimestamp(self.started_at).isoformat(),
+            "seconds": self.seconds,
+            "status": self.status,
+            "detail": self.detail,
+            "error": repr(self.error) if self.error else None,
+            "reauth": dict(self.reauth),
+            "stages": {name: dict(counters) for name, counters in self.stages.items()},
+        }
+
+    def save(self, reports_path: pathlib.Path, keep=RUN_REPORTS_KEEP):
+        reports_path.mkdir(parents=True, exist_ok=True)
+        started_at = datetime.datetime.fromtimestamp(self.started_at)
+        report_path = reports_path.joinpath(f"{encode_takeout_timestamp(started_at)}.json")
+        report_path.write_text(json.dumps(self.report(), indent=2, ensure_ascii=False))
+        for old_report_path in sorted(reports_path.glob("*.json"))[:-keep]:
+            old_report_path.unlink()
+        return report_path
+
+
+def write_prometheus_textfile(path: pathlib.Path, runs):
+    """Writes metrics of the runs in node_exporter textfile collector format"""
+    samples = collections.defaultdict(list)
+    for metrics in runs:
+        labels = f'account="{metrics.account}"'
+        samples["takeout_backup_last_run_timestamp_seconds"].append((labels, metrics.started_at))
+        samples["takeout_backup_last_run_seconds"].append((labels, metrics.seconds))
+        samples["takeout_backup_last_run_success"].append((labels, int(metrics.status != "failed")))
+        for step, count in metrics.reauth.items():
+            samples["takeout_backup_reauth_steps"].append((f'{labels},step="{step}"', count))
+        for stage, counters in metrics.stages.items():
+            for key, value in counters.items():
+                samples[f"takeout_backup_stage_{key}"].append(
+                    (f'{labels},stage="{stage}"', value)
+                )
+    lines = []
+    for name, values in samples.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines += [f"{name}{{{labels}}} {value}" for labels, value in values]
+    # the collector may read the file any time, so it is replaced atomically
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text("\n".join(lines) + "\n")
+    tmp_path.replace(path)
+
+
+class PageCapture:
+    """Last console messages and network events of a page, kept to be dumped as diagnostics on failure.
+
+    Events are stored as raw fields in ring buffers of size entries and formatted only when dumped
+    """
+
+    def __init__(
+        self, page, size=CAPTURE_BUFFER_SIZE, network=CAPTURE_NETWORK, domains=CAPTURE_DOMAINS
+    ):
+        self.console = collections.deque(maxlen=size)
+        self.network = collections.deque(maxlen=size)
+        self.seen = collections.Counter()
+        self.domains = domains
+        page.on("console", self.handle_console)
+        if network == "all":
+            page.on("request", self.handle_request)
+            page.on("response", self.handle_response)
+        elif network == "filtered":
+            page.on("request", self.handle_request_filtered)
+            page.on("response", self.handle_response_filtered)
+        if network != "off":
+            page.on("requestfailed", self.handle_request_failed)
+
+    def is_captured_domain(self, url):
+        host = urllib.parse.urlsplit(url).hostname or ""
+        return host.endswith(self.domains)
+
+    def handle_console(self, msg):
+        self.seen["console"] += 1
+        self.console.append((time.time(), msg.type, msg.text))
+
+    def handle_request(self, request):
+        self.seen["network"] += 1
+        self.network.append((time.time(), "Request", request.method, request.url))
+
+    def handle_response(self, response):
+        self.seen["network"] += 1
+        self.network.append((time.time(), "Response", response.status, response.url))
+
+    def handle_request_filtered(self, request):
+        if self.is_captured_domain(request.url):
+            self.handle_request(request)
+
+    def handle_response_filtered(self, response):
+        if response.status >= 400 or self.is_captured_domain(response.url):
+            self.handle_response(response)
+
+    def handle_request_failed(self, request):
+        self.seen["network"] += 1
+        self.network.append((time.time(), "Failed", request.failure, request.url))
+
+    def dump(self, path_prefix: pathlib.Path):
+        for kind, events in (("console", self.console), ("net", self.network)):
+            if not events:
+                continue
+            seen = self.seen["console" if kind == "console" else "network"]
+            lines = [f"last {len(events)} of {seen} captured events"]
+            lines += [
+                f"{datetime.datetime.fromtimestamp(timestamp).isoformat(timespec="milliseconds")} "
+                + " ".join(str(field) for field in fields)
+                for timestamp, *fields in events
+            ]
+            path_prefix.with_name(f"{path_prefix.name}.{kind}").write_text("\n".join(lines))
+
+
+def load_accounts(config_path=ACCOUNTS_CONFIG):
+    """Accounts listed in config_path json or the single account configured by env.
+
+    Each config entry needs a name, other fields default to per-account locations:
+    auth - accounts/{name}/.auth_encoded, downloads - downloads/{name}, photos - photos/{name},
+    encoded_pass - ENCODED_PASS_{NAME} env, browser_url - /srv/{name} path of BROWSER_SERVER_URL
+    """
+    browser_url = os.getenv("BROWSER_SERVER_URL", "ws://localhost:8082/srv")
+    if not config_path:
+        return [
+            BackupAccount(
+                None,
+                pathlib.Path(".auth_encoded"),
+                pathlib.Path("downloads"),
+                pathlib.Path("photos"),
+                os.getenv("ENCODED_PASS"),
+                browser_url,
+            )
+        ]
+    accounts = []
+    for config in json.loads(pathlib.Path(config_path).read_text()):
+        name = config["name"]
+        accounts.append(
+            BackupAccount(
+                name,
+                pathlib.Path(config.get("auth", f"accounts/{name}/.auth_encoded")),
+                pathlib.Path(config.get("downloads", f"downloads/{name}")),
+                pathlib.Path(config.get("photos", f"photos/{name}")),
+                config.get(
+                    "encoded_pass",
+                    os.getenv(f"ENCODED_PASS_{re.sub(r"\W", "_", name).upper()}"),
+                ),
+                config.get(
+                    "browser_url", f"{browser_url.rstrip("/").removesuffix("/srv")}/srv/{name}"
+                ),
+            )
+        )
+    if len({account.name for account in accounts}) != len(accounts):
+        raise Exception(f"account names in {config_path} must be unique")
+    return accounts
+
 
-downloads_path = pathlib.Path("downloads")
-backup_path = pathlib.Path("photos")
-timestamp_path = backup_path.joinpath(".timestamp")
 text_labels_source = pathlib.Path(f"keys_{os.getenv("GOOGLE_LANG", "RU")}.csv")
 
 with text_labels_source.open(mode="rt") as labels_data:
     text_labels = {row[0]: row[1] for row in csv.reader(labels_data, delimiter="=")}
 
+YEAR_FOLDER_PATTERNS = [
+    re.compile(text_labels["year.folder.template"]),
+    re.compile(r"Photos from (\d{4})"),
+]
+EDITED_SUFFIXES = ["-edited", "-effects", "-smile", "-mix"]
+if "edited.suffix" in text_labels:
+    EDITED_SUFFIXES.append(text_labels["edited.suffix"])
+# sidecar names are cut to 51 chars, so the suffix may be truncated anywhere
+SIDECAR_SUFFIX_PATTERN = re.compile(
+    "(?:"
+    + "|".join(re.escape(".supplemental-metadata"[:n]) for n in range(22, 1, -1))
+    + ")$"
+)
+SIDECAR_TRUNCATED_NAME_LENGTH = 46
+# media extensions mimetypes doesn't know everywhere: motion photos, camera videos and raws
+MEDIA_EXTRA_EXTENSIONS = {
+    ".mp", ".mv", ".mts", ".m2ts", ".3gp", ".heic", ".heif", ".dng", ".cr2", ".nef", ".arw", ".orf", ".raf", ".rw2"
+}
+COUNTER_PATTERN = re.compile(r"^(.*)(\(\d+\))$")
+
+
+async def probe_archive_timestamp(page, account: BackupAccount, ready_archive_link):
+    await page.goto(f"{TAKEOUT_BASEURL}{ready_archive_link}")
+    await handle_reauth(page, account, target_url=f"{TAKEOUT_BASEURL}{ready_archive_link}")
+    report_download_button = page.locator(
+        f'a[aria-label="{text_labels["report.download"]}"]'
+    )
+    async with page.expect_download(timeout=TIMEOUT_MILLIS * 2) as download_info:
+        await report_download_button.click()
+        await handle_reauth(page, account, settled_by=download_info)
+    download_meta = await download_info.value
+    await download_meta.cancel()
+    return parse_takeout_timestamp(download_meta.suggested_filename.split("-", 3)[1])
+
 
 async def filter_most_recent_archive(
-    page, ready_archive_links, last_snapshot_timestamp: datetime.datetime
+    page,
+    account: BackupAccount,
+    ready_archive_links,
+    last_snapshot_timestamp: datetime.datetime,
+    concurrency=ARCHIVE_PROBE_CONCURRENCY,
 ):
-    for ready_archive_link in ready_archive_links:
-        await page.goto(f"{TAKEOUT_BASEURL}{ready_archive_link}")
-        await handle_reauth(page, target_url=f"{TAKEOUT_BASEURL}{ready_archive_link}")
-        report_download_button = page.locator(
-            f'a[aria-label="{text_labels["report.download"]}"]'
-        )
-        async with page.expect_download(timeout=TIMEOUT_MILLIS * 2) as download_info:
-            await report_download_button.click()
-            await handle_reauth(page)
-        download_meta = await download_info.value
-        current_archive_timestamp = parse_takeout_timestamp(
-            download_meta.suggested_filename.split("-", 3)[1]
+    """Finds the first archive newer than the last snapshot.
+
+    Archive timestamps are known only from the report download, so links are probed
+    concurrently on separate pages and resolved timestamps are cached to never probe them again
+    """
+    cache_path = account.archive_timestamps_path
+    archive_timestamps = json.loads(cache_path.read_text()) if cache_path.exists() else {}
+
+    async def probe(ready_archive_link):
+        probe_page = await page.context.new_page()
+        probe_page.set_default_timeout(TIMEOUT_MILLIS)
+        async with probe_page:
+            archive_timestamps[ready_archive_link] = encode_takeout_timestamp(
+                await probe_archive_timestamp(probe_page, account, ready_archive_link)
+            )
+
+    try:
+        for i in range(0, len(ready_archive_links), concurrency):
+            links = ready_archive_links[i : i + concurrency]
+            await asyncio.gather(
+                *[probe(link) for link in links if link not in archive_timestamps]
+            )
+            for ready_archive_link in links:
+                current_archive_timestamp = parse_takeout_timestamp(
+                    archive_timestamps[ready_archive_link]
+                )
+                if (
+                    not last_snapshot_timestamp
+                    or current_archive_timestamp > last_snapshot_timestamp
+                ):
+                    return ready_archive_link, current_archive_timestamp
+    finally:
+        # links of expired archives disappear from the list, so do they from the cache
+        cache_path.write_text(
+            json.dumps(
+                {
+                    link: archive_timestamps[link]
+                    for link in ready_archive_links
+                    if link in archive_timestamps
+                },
+                indent=2,
+            )
         )
-        await download_meta.cancel()
-        if (
-            not last_snapshot_timestamp
-            or current_archive_timestamp > last_snapshot_timestamp
-        ):
-            return ready_archive_link, current_archive_timestamp
 
     return None, None
 
 
-async def handle_reauth(page, target_url=None, timeout_millis=TIMEOUT_MILLIS * 2, max_tries=3):
-    tries = 0
-    while tries < max_tries:
-        if page.url.startswith("https://accounts.google.com/v3/signin/accountchooser"):
+def reauth_step(url):
+    return next(
+        (step for step, prefix in REAUTH_URL_PREFIXES.items() if url.startswith(prefix)),
+        None,
+    )
+
+
+async def wait_for_reauth_step(page, settled_by=None, timeout_millis=REAUTH_DETECT_MILLIS):
+    """Returns reauth step the page is at or navigates to within timeout.
+
+    Returns None right away once settled_by event info of an expect_* call started before the action
+    is resolved, as it proves no reauth is needed. It usually is by the time the action returns
+    """
+    if step := reauth_step(page.url):
+        return step
+    if settled_by and settled_by.is_done():
+        return None
+    # shielded, so giving up on it doesn't cancel the awaited event
+    if settled_by:
+        settled = asyncio.shield(settled_by.value)
+    else:
+        settled = asyncio.get_running_loop().create_future()
+    navigation = asyncio.ensure_future(
+        page.wait_for_url(
+            lambda url: reauth_step(url) is not None,
+            wait_until="commit",
+            timeout=timeout_millis,
+        )
+    )
+    try:
+        await asyncio.wait([navigation, settled], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        settled.cancel()
+        navigation.cancel()
+    if navigation.done() and not navigation.cancelled() and not navigation.exception():
+        return reauth_step(page.url)
+    return None
+
+
+async def handle_reauth(
+    page,
+    account: BackupAccount,
+    target_url=None,
+    settled_by=None,
+    timeout_millis=TIMEOUT_MILLIS * 2,
+    max_tries=3,
+):
+    if target_url and page.url.startswith(target_url):
+        account.reauth_counter["not.required"] += 1
+        return
+    for try_n in range(max_tries):
+        step = await wait_for_reauth_step(page, settled_by)
+        if not step:
+            if try_n == 0:
+                account.reauth_counter["not.required"] += 1
+            return
+        account.reauth_counter[step] += 1
+        print(f"reauth step {step} on {page.url}")
+        if step == "account.chooser":
             await page.locator("form").or_(page.locator("ul")).locator("li>div").first.click()
-        elif page.url.startswith("https://gds.google.com/web/homeaddress"):
+        elif step == "home.address":
             element_by_exact_text = page.get_by_text(f"{text_labels["skip"]}")
             await element_by_exact_text.click()
-        await asyncio.sleep(timeout_millis / 1000 / max_tries)
-        if page.url.startswith("https://accounts.google.com/v3/signin/challenge/pwd"):
+        elif step == "password.challenge":
             await page.fill(
-                selector="input[type=password]", value=os.getenv("ENCODED_PASS")
+                selector="input[type=password]", value=account.encoded_pass
             )
             await page.locator(f"button#passwordNext").or_(
                 page.locator(f"div#passwordNext")
@@ -80,61 +557,974 @@ async def handle_reauth(page, target_url=None, timeout_millis=TIMEOUT_MILLIS * 2
                     lambda u: u.startswith(target_url), timeout=timeout_millis
                 )
             return
-        tries += 1
+        await page.wait_for_url(
+            lambda url: reauth_step(url) != step, wait_until="commit", timeout=timeout_millis
+        )
 
 
-async def main():
-    print(f"{TIMEOUT_MILLIS=}")
-    if not auth_json_path:
+def parse_size(text):
+    if match := SIZE_PATTERN.search(text or ""):
+        return float(match.group(1).replace(",", ".")) * SIZE_UNITS[match.group(2).upper()]
+    return None
+
+
+async def estimate_part_sizes(archive_parts, manifest: ArchiveManifest):
+    """Sizes of parts by index: actual ones of downloaded parts, the ones shown on the archive page
+    or ARCHIVE_PART_SIZE_GB if the page doesn't show them"""
+    sizes = {}
+    guessed = []
+    for i, archive_part in enumerate(archive_parts, 1):
+        part = manifest.part(i)
+        sizes[i] = part.get("size") or (
+            parse_size(await archive_part.get_attribute("aria-label"))
+            or parse_size(await archive_part.inner_text())
+        )
+        if not sizes[i]:
+            sizes[i] = ARCHIVE_PART_SIZE
+            guessed.append(i)
+    if guessed:
+        print(
+            f"warning: archive page shows no size of parts {guessed}, assuming ARCHIVE_PART_SIZE_GB="
+            f"{ARCHIVE_PART_SIZE / 2**30:g} each. Set it to the part size chosen for the export, "
+            f"otherwise the disk usage plan is off"
+        )
+    return sizes
+
+
+def indexed_bytes(index_file: pathlib.Path):
+    if not index_file.exists():
+        return 0
+    with contextlib.closing(open_backup_index(index_file)) as index:
+        return index.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+
+
+def plan_disk_usage(
+    part_sizes,
+    manifest: ArchiveManifest,
+    downloads_path: pathlib.Path,
+    backup_path: pathlib.Path,
+    index_file: pathlib.Path,
+    download_concurrency=DOWNLOAD_CONCURRENCY,
+    pipelined=PIPELINED_EXTRACTION,
+    delete_parts=DELETE_EXTRACTED_PARTS,
+):
+    """Estimates the space the rest of the run needs and picks the extraction strategy it fits in.
+
+    Media is stored in zips as is, so unpacked tree is about the size of the parts. Processing moves
+    files in place, merge moves them when photos share a filesystem with downloads and copies only
+    files absent from the backup index otherwise. When zips and unpacked tree don't fit together,
+    parts are unpacked as soon as they are downloaded and deleted right after.
+    Raises InsufficientSpaceError when even that doesn't fit
+    """
+    margin = 1 + DISK_SPACE_MARGIN
+    pending = [i for i, _ in part_sizes.items() if manifest.part(i)["state"] == "pending"]
+    to_download = sum(part_sizes[i] for i in pending)
+    to_unpack = sum(
+        size
+        for i, size in part_sizes.items()
+        if manifest.part(i)["state"] in ("pending", "downloaded")
+    )
+    downloads_free = shutil.disk_usage(downloads_path).free
+    same_fs = os.stat(downloads_path).st_dev == os.stat(backup_path).st_dev
+    # the whole export is downloaded each time, so merge writes about what isn't backed up yet
+    to_merge = 0 if same_fs else max(0, sum(part_sizes.values()) - indexed_bytes(index_file))
+    plan = {
+        "download_bytes": to_download,
+        "unpack_bytes": to_unpack,
+        "merge_bytes": to_merge,
+        "downloads_free_bytes": downloads_free,
+        "pipelined": pipelined,
+        "delete_parts": delete_parts,
+    }
+    largest_parts = sorted((part_sizes[i] for i in pending), reverse=True)
+    streaming_peak = to_unpack + sum(largest_parts[: download_concurrency + 1])
+    if not (pipelined and delete_parts) and (to_download + to_unpack) * margin > downloads_free:
+        if streaming_peak * margin > downloads_free:
+            raise InsufficientSpaceError(
+                f"{downloads_path} has {format_size(downloads_free)} free, but needs "
+                f"{format_size((to_download + to_unpack) * margin)} to download and unpack the archive "
+                f"or at least {format_size(streaming_peak * margin)} unpacking and deleting parts as they are downloaded"
+            )
+        print(
+            f"{downloads_path} can't hold both parts and unpacked tree, "
+            f"unpacking and deleting parts as soon as they are downloaded"
+        )
+        plan["pipelined"] = plan["delete_parts"] = True
+    elif pipelined and delete_parts and streaming_peak * margin > downloads_free:
+        raise InsufficientSpaceError(
+            f"{downloads_path} has {format_size(downloads_free)} free, "
+            f"but needs {format_size(streaming_peak * margin)} to download and unpack the archive"
+        )
+    if to_merge:
+        backup_free = shutil.disk_usage(backup_path).free
+        plan["backup_free_bytes"] = backup_free
+        if to_merge * margin > backup_free:
+            raise InsufficientSpaceError(
+                f"{backup_path} has {format_size(backup_free)} free, "
+                f"but about {format_size(to_merge * margin)} of new files are going to be copied there"
+            )
+    print(
+        f"disk plan: download {format_size(to_download)}, unpack {format_size(to_unpack)}, "
+        f"copy {format_size(to_merge)} to {backup_path}, {format_size(downloads_free)} free in {downloads_path}, "
+        f"pipelined extraction {plan["pipelined"]}, delete extracted parts {plan["delete_parts"]}"
+    )
+    return plan
+
+
+def write_chunk(file, digest, binary):
+    data = base64.b64decode(binary)
+    digest.update(data)
+    file.write(data)
+
+
+async def stream_download(download_meta, part_path: pathlib.Path):
+    """Writes the download to part_path as it is read from the browser, returns its sha256.
+
+    That's the transfer save_as does for a remote browser, reimplemented over the private artifact
+    channel to hash chunks on the way and to write a chunk while the next one is read
+    """
+    from playwright._impl._connection import from_channel
+
+    artifact = download_meta._impl_obj._artifact
+    stream = from_channel(await artifact._channel.send("saveAsStream", None))
+    digest = hashlib.sha256()
+    tmp_path = part_path.with_name(f"{part_path.name}.tmp")
+    with tmp_path.open("wb") as part_file:
+        write = None
+        while binary := await stream._channel.send(
+            "read", None, {"size": DOWNLOAD_STREAM_CHUNK_SIZE}
+        ):
+            if write:
+                await write
+            write = asyncio.ensure_future(
+                asyncio.to_thread(write_chunk, part_file, digest, binary)
+            )
+        if write:
+            await write
+    tmp_path.replace(part_path)
+    return digest.hexdigest()
+
+
+async def move_shared_download(download_meta, part_path: pathlib.Path, browser_downloads_path):
+    """Renames the file the browser has downloaded into a dir shared with this host to part_path.
+
+    Nothing is copied or hashed, contents are verified by zip CRCs on extraction
+    """
+    if failure := await download_meta.failure():
+        raise Error(f"download failed: {failure}")
+    artifact = download_meta._impl_obj._artifact
+    browser_file = pathlib.Path(
+        browser_downloads_path, pathlib.PurePosixPath(artifact.absolute_path).name
+    )
+    browser_file.replace(part_path)
+    return None
+
+
+async def save_download(download_meta, part_path: pathlib.Path, mode=DOWNLOAD_MODE):
+    """Saves the download to part_path the way mode sets, returns sha256 if it is known without another read.
+
+    Parts are never read back just to hash them, their contents are verified by zip CRCs on extraction
+    """
+    if mode == "shared":
+        try:
+            return await move_shared_download(download_meta, part_path, BROWSER_DOWNLOADS_PATH)
+        except (OSError, AttributeError) as e:
+            print(f"failed to move shared download with {e!r}, streaming it")
+            mode = "stream"
+    if mode == "stream":
+        try:
+            return await stream_download(download_meta, part_path)
+        except (ImportError, AttributeError, TypeError) as e:
+            # private api has changed between playwright versions
+            print(f"streaming download isn't supported by playwright: {e!r}, using save_as")
+            part_path.with_name(f"{part_path.name}.tmp").unlink(missing_ok=True)
+    await download_meta.save_as(part_path)
+    return None
+
+
+async def download_archive_parts(
+    page,
+    account: BackupAccount,
+    archive_parts,
+    target_path: pathlib.Path,
+    manifest: ArchiveManifest,
+    shared_slots: asyncio.Semaphore,
+    concurrency=DOWNLOAD_CONCURRENCY,
+    on_part_downloaded=None,
+    stats: collections.Counter = None,
+):
+    """Downloads parts not downloaded yet, at most concurrency of them and shared_slots across accounts at once.
+
+    Counts downloaded parts, bytes, skipped parts and retries in stats
+    """
+    # clicks have to be serialized to match each part with its download event,
+    # the transfers themselves run concurrently in the browser
+    click_lock = asyncio.Lock()
+    download_slots = asyncio.Semaphore(concurrency)
+    started_at = time.monotonic()
+    downloaded = collections.Counter() if stats is None else stats
+
+    async def download_part(i, archive_part):
+        if manifest.is_downloaded(i, target_path):
+            print(f"part {i} is already downloaded, skipping")
+            downloaded["skipped"] += 1
+            return
+        manifest.update_part(i, href=await archive_part.get_attribute("href"))
+        async with download_slots, shared_slots:
+            async with click_lock:
+                async with page.expect_download(
+                    timeout=TIMEOUT_MILLIS * 2
+                ) as download_info:
+                    await archive_part.click()
+                    await handle_reauth(page, account, settled_by=download_info)
+                download_meta = await download_info.value
+            part_path = target_path.joinpath(download_meta.suggested_filename)
+            for try_n in range(1, 4):
+                try:
+                    part_sha256 = await save_download(download_meta, part_path)
+                    break
+                except Error:
+                    if try_n >= 3:
+                        raise
+                    print(f"retrying download {i} after {try_n}")
+                    downloaded["retries"] += 1
+
+            await download_meta.delete()
+            part_size = part_path.stat().st_size
+            manifest.update_part(
+                i,
+                filename=part_path.name,
+                size=part_size,
+                sha256=part_sha256,
+                state="downloaded",
+            )
+            if on_part_downloaded:
+                on_part_downloaded(i)
+            downloaded["parts"] += 1
+            downloaded["bytes"] += part_size
+            elapsed = time.monotonic() - started_at
+            print(
+                f"downloaded {downloaded["parts"]}/{len(archive_parts)} parts (part {i}), "
+                f"{format_size(downloaded["bytes"])} in {elapsed:.0f}s, "
+                f"{format_size(downloaded["bytes"] / max(elapsed, 1e-3))}/s"
+            )
+
+    tasks = [
+        asyncio.create_task(download_part(i, archive_part))
+        for i, archive_part in enumerate(archive_parts, 1)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def extract_members(
+    part_path: pathlib.Path, target_path: pathlib.Path, member_names, bandwidth=0
+):
+    """Unpacks given members of a zip part, runs in an extraction pool worker.
+
+    Safe to run concurrently for parts sharing the same tree. Corrupt members are
+    returned as errors instead of failing the whole batch. Writes are capped by bandwidth bytes per second if given
+    """
+    started_at = time.monotonic()
+    limiter = BandwidthLimiter(bandwidth)
+    stats = {"bytes": 0, "files": 0, "errors": []}
+    with zipfile.ZipFile(part_path, "r") as archive:
+        for member_name in member_names:
+            member_path = None
+            try:
+                member = archive.getinfo(member_name)
+                name = pathlib.PurePosixPath(member.filename)
+                if name.is_absolute() or ".." in name.parts:
+                    raise zipfile.BadZipFile(f"member points outside of {target_path}")
+                member_path = target_path.joinpath(name)
+                if member.is_dir():
+                    member_path.mkdir(parents=True, exist_ok=True)
+                    continue
+                member_path.parent.mkdir(parents=True, exist_ok=True)
+                # zipfile verifies CRC once the member is read to the end
+                with archive.open(member) as src, member_path.open("wb") as dst:
+                    while chunk := src.read(EXTRACTION_BUFFER_SIZE):
+                        dst.write(chunk)
+                        limiter.throttle(len(chunk))
+                # stable mtime for media without a sidecar timestamp
+                member_mtime = time.mktime(member.date_time + (0, 0, -1))
+                os.utime(member_path, (member_mtime, member_mtime))
+                stats["bytes"] += member.file_size
+                stats["files"] += 1
+            except (zipfile.BadZipFile, zlib.error, EOFError, OSError, KeyError) as e:
+                if member_path and member_path.is_file():
+                    member_path.unlink()
+                stats["errors"].append(
+                    {"part": part_path.name, "member": member_name, "error": repr(e)}
+                )
+    stats["seconds"] = time.monotonic() - started_at
+    return stats
+
+
+def plan_member_batches(members, batches_count):
+    """Spreads members over batches of about equal unpacked size, largest members first"""
+    batches = [[] for _ in range(batches_count)]
+    batch_sizes = [0] * batches_count
+    for member in sorted(members, key=lambda m: m.file_size, reverse=True):
+        smallest = batch_sizes.index(min(batch_sizes))
+        batches[smallest].append(member.filename)
+        batch_sizes[smallest] += member.file_size
+    return [batch for batch in batches if batch]
+
+
+async def extract_downloaded_part(
+    executor,
+    manifest: ArchiveManifest,
+    i,
+    target_path: pathlib.Path,
+    delete_part=DELETE_EXTRACTED_PARTS,
+    workers=EXTRACTION_WORKERS,
+    bandwidth=0,
+    known_members=None,
+):
+    """Unpacks a downloaded part across the extraction pool, returns unpacking stats.
+
+    A part with corrupt members is switched back to pending to be downloaded again by the next run.
+    Media members found in known_members by name, size and CRC are left packed as already backed up,
+    they are listed with the unpacked ones in {part}.members.json next to the part
+    """
+    part_path = target_path.joinpath(manifest.part(i)["filename"])
+    started_at = time.monotonic()
+    skipped = []
+    batch_stats = []
+    try:
+        with zipfile.ZipFile(part_path, "r") as archive:
+            members = archive.infolist()
+        if known_members:
+            # sidecars are tiny and may belong to new edited media, so they are always unpacked
+            skipped = [
+                m
+                for m in members
+                if not m.is_dir()
+                and is_media_file(m.filename)
+                and known_members.get(m.filename) == (m.file_size, m.CRC)
+            ]
+            skipped_names = {m.filename for m in skipped}
+            members = [m for m in members if m.filename not in skipped_names]
+        write_part_members(target_path, part_path.name, members, skipped)
+    except (zipfile.BadZipFile, OSError) as e:
+        members = []
+        batch_stats = [
+            {
+                "bytes": 0,
+                "files": 0,
+                "errors": [{"part": part_path.name, "member": None, "error": repr(e)}],
+            }
+        ]
+    if members:
+        loop = asyncio.get_running_loop()
+        batch_stats = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    executor, extract_members, part_path, target_path, batch, bandwidth
+                )
+                for batch in plan_member_batches(members, workers)
+            ]
+        )
+    stats = {
+        "part": part_path.name,
+        "bytes": sum(b["bytes"] for b in batch_stats),
+        "files": sum(b["files"] for b in batch_stats),
+        "skipped": len(skipped),
+        "errors": [error for b in batch_stats for error in b["errors"]],
+        "seconds": time.monotonic() - started_at,
+    }
+    print(
+        f"unpacked part {i} {part_path.name}: {stats["files"]} files, "
+        f"{stats["skipped"]} already backed up, "
+        f"{format_size(stats["bytes"])} in {stats["seconds"]:.0f}s, "
+        f"{format_size(stats["bytes"] / max(stats["seconds"], 1e-3))}/s, "
+        f"{len(stats["errors"])} errors"
+    )
+    if stats["errors"]:
+        manifest.update_part(i, state="pending", errors=stats["errors"])
+        return stats
+    manifest.update_part(i, state="extracted", errors=[])
+    if delete_part:
+        part_path.unlink()
+    return stats
+
+
+def write_part_members(target_path: pathlib.Path, part_name, unpacked, skipped):
+    members_path = target_path.joinpath(f"{part_name}.members.json")
+    tmp_path = members_path.with_name(f"{members_path.name}.tmp")
+    tmp_path.write_text(
+        json.dumps(
+            {
+                "unpacked": [
+                    [m.filename, m.file_size, m.CRC]
+                    for m in unpacked
+                    if not m.is_dir() and is_media_file(m.filename)
+                ],
+                "skipped": [[m.filename, m.file_size] for m in skipped],
+            },
+            ensure_ascii=False,
+        )
+    )
+    tmp_path.replace(members_path)
+
+
+def read_part_members(target_path: pathlib.Path, key):
+    return [
+        member
+        for members_path in sorted(target_path.glob("*.members.json"))
+        for member in json.loads(members_path.read_text())[key]
+    ]
+
+
+def open_backup_index(path: pathlib.Path):
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, sha256 TEXT NOT NULL)"
+    )
+    # takeout zip members already merged into the backup, as the central directory describes them
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS members ("
+        "name TEXT PRIMARY KEY, size INTEGER NOT NULL, crc INTEGER NOT NULL)"
+    )
+    return connection
+
+
+def load_backed_up_members(index_file: pathlib.Path):
+    if not index_file.exists():
+        return {}
+    with contextlib.closing(open_backup_index(index_file)) as index:
+        return {
+            name: (size, crc)
+            for name, size, crc in index.execute("SELECT name, size, crc FROM members")
+        }
+
+
+def record_backed_up_members(index_file: pathlib.Path, members):
+    with contextlib.closing(open_backup_index(index_file)) as index:
+        index.executemany(
+            "INSERT OR REPLACE INTO members (name, size, crc) VALUES (?, ?, ?)", members
+        )
+        index.commit()
+
+
+def link_file(src: pathlib.Path, dst: pathlib.Path, link_mode=DEDUP_LINK):
+    """Atomically replaces dst with a hardlink or a reflink of src"""
+    tmp_path = dst.with_name(f".{dst.name}.link")
+    tmp_path.unlink(missing_ok=True)
+    if link_mode == "reflink":
+        with src.open("rb") as src_file, tmp_path.open("wb") as tmp_file:
+            try:
+                fcntl.ioctl(tmp_file.fileno(), FICLONE, src_file.fileno())
+            except OSError:
+                shutil.copyfileobj(src_file, tmp_file, EXTRACTION_BUFFER_SIZE)
+        shutil.copystat(src, tmp_path)
+    else:
+        os.link(src, tmp_path)
+    tmp_path.replace(dst)
+
+
+def store_deduplicated(
+    src: pathlib.Path,
+    dst: pathlib.Path,
+    file_hash,
+    blobs_dir: pathlib.Path,
+    move,
+    link_mode=DEDUP_LINK,
+):
+    """Keeps one blob per unique content and materialises dst as a link to it.
+
+    Returns whether the blob was already stored
+    """
+    blob = blobs_dir.joinpath(file_hash[:2], file_hash)
+    blob_exists = blob.exists()
+    if not blob_exists:
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        if move:
+            src.replace(blob)
+        else:
+            shutil.copy2(src, blob)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    link_file(blob, dst, link_mode)
+    return blob_exists
+
+
+def sync_to_backup(
+    source_path: pathlib.Path,
+    target_path: pathlib.Path,
+    index_file: pathlib.Path,
+    blobs_dir: pathlib.Path = None,
+    files=None,
+    bandwidth: BandwidthLimiter = None,
+):
+    """Moves or copies into target only files absent from its index or changed since indexed.
+
+    Index describes the files in target by relative path, so unchanged files are skipped by
+    a stat, without hashing. Source files are consumed: renamed when both trees share a filesystem.
+    With blobs_dir every unique content is stored once there and target paths are links to it.
+    Relative paths of source files may be given in files to avoid walking the source tree.
+    Copies are paced by bandwidth limiter if given
+    """
+    stats = {"added": 0, "updated": 0, "skipped": 0, "deduplicated": 0, "bytes": 0}
+    same_fs = os.stat(source_path).st_dev == os.stat(target_path).st_dev
+    indexed_count = 0
+    with contextlib.closing(open_backup_index(index_file)) as index:
+        if files is None:
+            files = (
+                root.joinpath(name).relative_to(source_path).as_posix()
+                for root, dirs, names in source_path.walk()
+                for name in names
+            )
+        for rel_path in files:
+            src = source_path.joinpath(rel_path)
+            dst = target_path.joinpath(rel_path)
+            try:
+                src_stat = src.stat()
+            except FileNotFoundError:
+                # moved by an interrupted run
+                continue
+            try:
+                dst_stat = dst.stat()
+            except FileNotFoundError:
+                dst_stat = None
+            row = index.execute(
+                "SELECT size, mtime_ns, sha256 FROM files WHERE path = ?", (rel_path,)
+            ).fetchone()
+            if (
+                row
+                and dst_stat
+                and row[0] == src_stat.st_size == dst_stat.st_size
+                and row[1] == src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+            ):
+                stats["skipped"] += 1
+                continue
+            src_hash = file_sha256(src)
+            dst_hash = None
+            if dst_stat and dst_stat.st_size == src_stat.st_size:
+                dst_indexed = (
+                    row and row[0] == dst_stat.st_size and row[1] == dst_stat.st_mtime_ns
+                )
+                dst_hash = row[2] if dst_indexed else file_sha256(dst)
+            if dst_hash == src_hash:
+                os.utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+                if blobs_dir:
+                    # adopt files backed up before deduplication was enabled
+                    blob = blobs_dir.joinpath(src_hash[:2], src_hash)
+                    if not blob.exists():
+                        blob.parent.mkdir(parents=True, exist_ok=True)
+                        link_file(dst, blob)
+                    elif not os.path.samefile(blob, dst):
+                        link_file(blob, dst)
+                stats["skipped"] += 1
+            elif blobs_dir:
+                if store_deduplicated(src, dst, src_hash, blobs_dir, move=same_fs):
+                    stats["deduplicated"] += 1
+                else:
+                    stats["bytes"] += src_stat.st_size
+                    if bandwidth and not same_fs:
+                        bandwidth.throttle(src_stat.st_size)
+                stats["updated" if dst_stat else "added"] += 1
+            else:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                if same_fs:
+                    src.replace(dst)
+                else:
+                    shutil.copy2(src, dst)
+                    if bandwidth:
+                        bandwidth.throttle(src_stat.st_size)
+                stats["updated" if dst_stat else "added"] += 1
+                stats["bytes"] += src_stat.st_size
+            index.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                (rel_path, src_stat.st_size, src_stat.st_mtime_ns, src_hash),
+            )
+            indexed_count += 1
+            if indexed_count % 1000 == 0:
+                index.commit()
+        index.commit()
+    return stats
+
+
+def collect_garbage(
+    target_path: pathlib.Path, index_file: pathlib.Path, blobs_dir: pathlib.Path
+):
+    """Forgets indexed paths deleted from target and removes blobs no path refers to anymore"""
+    with contextlib.closing(open_backup_index(index_file)) as index:
+        deleted_paths = [
+            path
+            for (path,) in index.execute("SELECT path FROM files").fetchall()
+            if not target_path.joinpath(path).exists()
+        ]
+        index.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in deleted_paths])
+        index.commit()
+        referenced = {h for (h,) in index.execute("SELECT DISTINCT sha256 FROM files")}
+    removed_blobs = 0
+    freed_bytes = 0
+    for blob in blobs_dir.glob("*/*"):
+        blob_stat = blob.stat()
+        # a hardlink outside the index still refers to the blob
+        if blob.name not in referenced and blob_stat.st_nlink == 1:
+            blob.unlink()
+            removed_blobs += 1
+            freed_bytes += blob_stat.st_size
+    print(
+        f"gc: forgot {len(deleted_paths)} deleted paths, removed {removed_blobs} blobs, "
+        f"freed {format_size(freed_bytes)}"
+    )
+
+
+def is_year_folder(name):
+    return any(pattern.fullmatch(name) for pattern in YEAR_FOLDER_PATTERNS)
+
+
+def is_media_file(name):
+    """Photo or video by extension, the rest of a takeout like archive_browser.html isn't media"""
+    if os.path.splitext(name)[1].lower() in MEDIA_EXTRA_EXTENSIONS:
+        return True
+    mime, _ = mimetypes.guess_type(name, strict=False)
+    return mime is not None and mime.startswith(("image/", "video/"))
+
+
+def find_photos_folder(unpacked_root: pathlib.Path):
+    """Google Photos folder of the unpacked takeout: the one holding year folders, as gpth looks for it"""
+    pending = [unpacked_root]
+    while pending:
+        folder = pending.pop(0)
+        subfolders = sorted(item for item in folder.iterdir() if item.is_dir())
+        if any(is_year_folder(item.name) for item in subfolders):
+            return folder
+        pending.extend(subfolders)
+    # takeout of albums only
+    subfolders = [item for item in unpacked_root.iterdir() if item.is_dir()]
+    return subfolders[0] if len(subfolders) == 1 else unpacked_root
+
+
+def sidecar_media_name(sidecar_name):
+    """Name of the media a takeout sidecar json describes, may be truncated"""
+    stem = sidecar_name.removesuffix(".json")
+    counter = ""
+    if m := COUNTER_PATTERN.match(stem):
+        stem, counter = m.groups()
+    stem = SIDECAR_SUFFIX_PATTERN.sub("", stem)
+    if counter:
+        # "IMG.jpg(1).json" describes "IMG(1).jpg"
+        base, dot, ext = stem.rpartition(".")
+        stem = f"{base}{counter}.{ext}" if dot else f"{stem}{counter}"
+    return stem
+
+
+def find_sidecar(media_name, sidecars):
+    candidates = [media_name]
+    base, dot, ext = media_name.rpartition(".")
+    for suffix in EDITED_SUFFIXES:
+        if dot and base.endswith(suffix):
+            candidates.append(f"{base.removesuffix(suffix)}.{ext}")
+    for candidate in candidates:
+        if sidecar := sidecars.get(candidate):
+            return sidecar
+        if sidecar := sidecars.get(candidate[:SIDECAR_TRUNCATED_NAME_LENGTH]):
+            return sidecar
+    return None
+
+
+def unique_name(name, used_names):
+    unique, counter = name, 0
+    base, dot, ext = name.rpartition(".")
+    while unique in used_names:
+        counter += 1
+        unique = f"{base}({counter}).{ext}" if dot else f"{name}({counter})"
+    used_names.add(unique)
+    return unique
+
+
+def scan_takeout(unpacked_root: pathlib.Path):
+    """Single scandir pass over the unpacked takeout, returns (folder, media entries, sidecars) in walk order"""
+    folders = []
+    pending = [str(unpacked_root)]
+    while pending:
+        folder = pending.pop()
+        media, sidecars, subfolders = {}, {}, []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                elif entry.name.endswith(".json"):
+                    sidecars[sidecar_media_name(entry.name)] = entry.path
+                elif is_media_file(entry.name):
+                    media[entry.name] = entry
+        pending.extend(sorted(subfolders, reverse=True))
+        if media:
+            folders.append((pathlib.Path(folder), media, sidecars))
+    return folders
+
+
+def plan_takeout_processing(
+    unpacked_root: pathlib.Path, output_path: pathlib.Path, skipped_media=()
+):
+    """Lays out media of the unpacked takeout the way gpth does with duplicate-copy albums.
+
+    Only photos and videos of the Google Photos folder are laid out. Media of year folders is flattened into output root, album media goes to output/{album},
+    media met in albums only goes to both. Operations are [src, dst, sidecar, copy_to],
+    outputs are paths relative to output root the plan is going to produce.
+    skipped_media are (path, size) of media left packed as already backed up: they take their names
+    and count as year media the same way as if they were unpacked, but produce no operations
+    """
+    photos_root = find_photos_folder(unpacked_root)
+    folders = {root: (media, sidecars) for root, media, sidecars in scan_takeout(photos_root)}
+    skipped = collections.defaultdict(dict)
+    for path, size in skipped_media:
+        path = pathlib.Path(path)
+        if photos_root not in path.parents or not is_media_file(path.name):
+            continue
+        skipped[path.parent][path.name] = size
+        folders.setdefault(path.parent, ({}, {}))
+    year_folders, album_folders = [], []
+    # the order scan_takeout walks the tree in, for names to be numbered the same as in a full run
+    for root in sorted(folders, key=lambda folder: folder.parts):
+        folder = (root, *folders[root], skipped.get(root, {}))
+        (year_folders if is_year_folder(root.name) else album_folders).append(folder)
+
+    def media_size(media, skipped_sizes, name):
+        if name in skipped_sizes:
+            return skipped_sizes[name]
+        return media[name].stat(follow_symlinks=False).st_size
+
+    album_media_names = {
+        name for _, media, _, skipped_sizes in album_folders for name in (*media, *skipped_sizes)
+    }
+    year_media_keys = {
+        (name, media_size(media, skipped_sizes, name))
+        for _, media, _, skipped_sizes in year_folders
+        for name in (*media, *skipped_sizes)
+        if name in album_media_names
+    }
+    operations = []
+    outputs = []
+    root_names = set()
+    for root, media, sidecars, skipped_sizes in year_folders:
+        for name in sorted({*media, *skipped_sizes}):
+            dst_name = unique_name(name, root_names)
+            if name in skipped_sizes:
+                continue
+            outputs.append(dst_name)
+            operations.append(
+                [
+                    media[name].path,
+                    str(output_path.joinpath(dst_name)),
+                    find_sidecar(name, sidecars),
+                    None,
+                ]
+            )
+    album_names = {}
+    for root, media, sidecars, skipped_sizes in album_folders:
+        used_names = album_names.setdefault(root.name, set())
+        for name in sorted({*media, *skipped_sizes}):
+            dst_name = f"{root.name}/{unique_name(name, used_names)}"
+            copy_name = None
+            if (name, media_size(media, skipped_sizes, name)) not in year_media_keys:
+                copy_name = unique_name(name, root_names)
+            if name in skipped_sizes:
+                continue
+            outputs.append(dst_name)
+            if copy_name:
+                outputs.append(copy_name)
+            operations.append(
+                [
+                    media[name].path,
+                    str(output_path.joinpath(dst_name)),
+                    find_sidecar(name, sidecars),
+                    str(output_path.joinpath(copy_name)) if copy_name else None,
+                ]
+            )
+    return {
+        "operations": operations,
+        "dirs": sorted({str(output_path)} | {str(output_path.joinpath(album)) for album in album_names}),
+        "outputs": outputs,
+    }
+
+
+def describe_plan(plan):
+    """Prints the processing plan per source folder along with its estimated cost"""
+    operations = plan["operations"]
+    per_folder = collections.defaultdict(lambda: collections.Counter())
+    for src, dst, sidecar, copy_to in operations:
+        folder_stats = per_folder[(os.path.dirname(src), os.path.dirname(dst))]
+        folder_stats["moves"] += 1
+        folder_stats["sidecars"] += sidecar is not None
+        folder_stats["copies"] += copy_to is not None
+    for (src_dir, dst_dir), folder_stats in per_folder.items():
+        print(
+            f"  {src_dir} -> {dst_dir}: {folder_stats["moves"]} moves, "
+            f"{folder_stats["sidecars"]} sidecars, {folder_stats["copies"]} album-only copies"
+        )
+    # a plan of an interrupted run has its first media moved to their destinations already
+    pending = [op for op in operations if os.path.exists(op[0])]
+    pending_sources = {op[0] for op in pending}
+    copies = [op for op in operations if op[3]]
+    copy_bytes = 0
+    for src, dst, _, _ in copies:
+        with contextlib.suppress(FileNotFoundError):
+            copy_bytes += os.stat(src if src in pending_sources else dst).st_size
+    sidecars = sum(1 for op in operations if op[2])
+    # exists + rename per move, read + utime per sidecar, exists + copy per album-only media
+    metadata_ops = len(plan["dirs"]) + 2 * len(operations) + 2 * sidecars + 2 * len(copies)
+    sample = pending[:100]
+    started_at = time.monotonic()
+    for op in sample:
+        os.stat(op[0])
+    op_seconds = (time.monotonic() - started_at) / max(len(sample), 1)
+    print(
+        f"plan: {len(plan["dirs"])} dirs, {len(operations)} moves ({len(pending)} pending), "
+        f"{sidecars} sidecar timestamps, "
+        f"{len(copies)} copies of {format_size(copy_bytes)}; "
+        f"~{metadata_ops} metadata ops, ~{metadata_ops * op_seconds:.0f}s at {op_seconds * 1000:.2f}ms per op "
+        f"plus copying"
+    )
+
+
+def read_sidecar_timestamp(sidecar):
+    with open(sidecar, "rb") as f:
+        meta = json.load(f)
+    for key in ("photoTakenTime", "creationTime"):
+        if timestamp := meta.get(key, {}).get("timestamp"):
+            return int(timestamp)
+    return None
+
+
+def apply_media_operations(operations):
+    """Moves a batch of media into processed layout applying sidecar timestamps, runs in a processing pool worker"""
+    results = collections.Counter()
+    for src, dst, sidecar, copy_to in operations:
+        if os.path.exists(src):
+            os.replace(src, dst)
+        elif not os.path.exists(dst):
+            results["missing"] += 1
+            continue
+        results["moved"] += 1
+        if sidecar:
+            try:
+                if timestamp := read_sidecar_timestamp(sidecar):
+                    os.utime(dst, (timestamp, timestamp))
+                    results["timestamped"] += 1
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"failed to apply {sidecar=} to {dst}: {e!r}")
+        if copy_to and not os.path.exists(copy_to):
+            shutil.copy2(dst, copy_to)
+            results["copied"] += 1
+    return results
+
+
+def process_takeout(
+    unpacked_root: pathlib.Path,
+    output_path: pathlib.Path,
+    plan_path: pathlib.Path,
+    workers=PROCESSING_WORKERS,
+    dry_run=PROCESSING_DRY_RUN,
+    stats: collections.Counter = None,
+    skipped_media=(),
+):
+    """Replaces gpth: matches media with sidecars, applies timestamps, builds flat and album layout.
+
+    The tree is scanned once into a plan, which is stored before it is applied in batches,
+    so an interrupted run resumes moving the remaining files. Returns the plan, results are counted in stats
+    """
+    timings = {}
+    started_at = time.monotonic()
+    if plan_path.exists():
+        # left by an interrupted run, some of its media may be moved already
+        plan = json.loads(plan_path.read_text())
+    else:
+        plan = plan_takeout_processing(unpacked_root, output_path, skipped_media)
+        if not dry_run:
+            plan_tmp_path = plan_path.with_name(f"{plan_path.name}.tmp")
+            plan_tmp_path.write_text(json.dumps(plan, ensure_ascii=False))
+            plan_tmp_path.replace(plan_path)
+    if dry_run:
+        describe_plan(plan)
+        return plan
+    timings["plan"] = time.monotonic() - started_at
+
+    started_at = time.monotonic()
+    for dst_dir in plan["dirs"]:
+        os.makedirs(dst_dir, exist_ok=True)
+    operations = plan["operations"]
+    # operations are in walk order, so a batch mostly touches the same pair of folders
+    batch_size = max(1, min(PROCESSING_BATCH_SIZE, len(operations) // (workers * 4)))
+    results = collections.Counter()
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for batch_results in executor.map(
+            apply_media_operations,
+            [operations[i : i + batch_size] for i in range(0, len(operations), batch_size)],
+        ):
+            results.update(batch_results)
+    timings["apply"] = time.monotonic() - started_at
+    if stats is not None:
+        stats["media"] += len(operations)
+        stats.update(results)
+    print(
+        f"processed takeout: {len(operations)} media, {results["timestamped"]} timestamped from sidecars, "
+        f"{results["missing"]} missing, {results["copied"]} album-only copies, "
+        + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in timings.items())
+    )
+    return plan
+
+
+async def backup_account(account: BackupAccount, limits: SharedLimits, metrics: RunMetrics):
+    """Runs the whole pipeline for one account, returns the reason to skip it or None once backed up"""
+    auth_json_path = account.auth_json_path
+    downloads_path = account.downloads_path
+    if not auth_json_path.exists():
         raise Exception(f"{auth_json_path} is required")
-    if not os.getenv("ENCODED_PASS"):
+    if not account.encoded_pass:
         raise Exception("ENCODED_PASS env is required")
+    downloads_path.mkdir(parents=True, exist_ok=True)
+    account.backup_path.mkdir(parents=True, exist_ok=True)
     # snapshot_in_progress = any(downloads_path.iterdir())
 
     last_snapshot_timestamp = None
-    if timestamp_path.exists():
-        last_snapshot_timestamp = parse_takeout_timestamp(timestamp_path.read_text())
+    if account.timestamp_path.exists():
+        last_snapshot_timestamp = parse_takeout_timestamp(account.timestamp_path.read_text())
+
+    known_members = None
+    if DELTA_MODE and last_snapshot_timestamp:
+        known_members = load_backed_up_members(account.index_path)
+        print(f"delta mode, {len(known_members)} media are backed up already")
 
-    print("inited config")
+    extraction_pool = limits.extraction_pool
+    extraction_tasks = []
     async with async_playwright() as playwright:
         async with await playwright.chromium.connect(
-            os.getenv("BROWSER_SERVER_URL", f"ws://localhost:8082/srv"),
+            account.browser_url,
             timeout=TIMEOUT_MILLIS,
         ) as browser:
             print("inited browser")
-            page = await browser.new_page(
+            context = await browser.new_context(
                 storage_state={"encoded_value": auth_json_path.read_text()},
                 accept_downloads=True,
                 viewport={"width": 1280, "height": 1024},
                 user_agent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
             )
+            page = await context.new_page()
             page.set_default_timeout(TIMEOUT_MILLIS)
             async with page:
-                console = []
-
-                async def handle_console(msg):
-                    console.append(msg.text)
-
-                page.on("console", handle_console)
-
-                network = []
-
-                async def handle_request(request):
-                    network.append(f"Request: {request.method} {request.url}")
-
-                async def handle_response(response):
-                    network.append(f"Response: {response.status} {response.url}")
-
-                page.on("request", handle_request)
-                page.on("response", handle_response)
-
+                capture = PageCapture(page)
                 print("inited page")
                 now = datetime.datetime.now()
                 try:
-                    await page.goto(f"{TAKEOUT_BASEURL}manage")
-                    if page.url.startswith("https://accounts.google.com/v3/signin"):
-                        print(f"auth required, trying to reauth on {page.url}")
-                        await handle_reauth(page, target_url=f"{TAKEOUT_BASEURL}manage")
+                    with metrics.stage("login"):
+                        await page.goto(f"{TAKEOUT_BASEURL}manage")
+                        if page.url.startswith("https://accounts.google.com/v3/signin"):
+                            print(f"auth required, trying to reauth on {page.url}")
+                            await handle_reauth(
+                                page, account, target_url=f"{TAKEOUT_BASEURL}manage"
+                            )
 
                     export_in_progress = page.locator(
                         f"text={text_labels["decline.export"]}"
@@ -155,26 +1545,22 @@ async def main():
                     if not await export_in_progress.is_hidden():
                         raise EarlyReturn("Currently export is in progress, exiting")
 
-                    for f in downloads_path.iterdir():
-                        if f.is_file():
-                            f.unlink()
-                        elif f.is_dir():
-                            shutil.rmtree(f)
-
-                    ready_archive_links = await page.locator(
-                        "a",
-                        has=page.locator(
-                            "p", has_text=f"{text_labels["export.ready.label"]}"
-                        ),
-                    ).all()
-                    ready_archive_links = [
-                        await link.get_attribute("href") for link in ready_archive_links
-                    ]
-                    target_archive, target_archive_timestamp = (
-                        await filter_most_recent_archive(
-                            page, ready_archive_links, last_snapshot_timestamp
+                    with metrics.stage("probe") as stage:
+                        ready_archive_links = await page.locator(
+                            "a",
+                            has=page.locator(
+                                "p", has_text=f"{text_labels["export.ready.label"]}"
+                            ),
+                        ).all()
+                        ready_archive_links = [
+                            await link.get_attribute("href") for link in ready_archive_links
+                        ]
+                        target_archive, target_archive_timestamp = (
+                            await filter_most_recent_archive(
+                                page, account, ready_archive_links, last_snapshot_timestamp
+                            )
                         )
-                    )
+                        stage["archives"] += len(ready_archive_links)
                     if not target_archive:
                         await request_new_archive(page)
                         raise EarlyReturn(
@@ -184,57 +1570,92 @@ async def main():
                     print(
                         f"selected target archive: {target_archive}, {target_archive_timestamp=}"
                     )
+                    target_archive_id = target_archive.split("/")[-1]
                     target_archive_download_path = downloads_path.joinpath(
-                        target_archive.split("/")[-1]
+                        target_archive_id
                     )
-                    target_archive_download_path.mkdir()
+                    manifest = ArchiveManifest(
+                        downloads_path.joinpath(f"{target_archive_id}.manifest.json"),
+                        target_archive_id,
+                    )
+                    for f in downloads_path.iterdir():
+                        if f in (target_archive_download_path, manifest.path, account.reports_path):
+                            continue
+                        if f.is_file():
+                            f.unlink()
+                        elif f.is_dir():
+                            shutil.rmtree(f)
+                    target_archive_download_path.mkdir(exist_ok=True)
                     await page.goto(f"{TAKEOUT_BASEURL}{target_archive}")
-                    await handle_reauth(page, target_url=f"{TAKEOUT_BASEURL}{target_archive}")
+                    await handle_reauth(
+                        page, account, target_url=f"{TAKEOUT_BASEURL}{target_archive}"
+                    )
                     archive_parts = await page.locator(
                         f'a[href*="takeout/download"]:not([aria-label*="{text_labels["report.download"]}"])'
                     ).all()
-                    print(f"going to download {len(archive_parts)} parts")
-                    try:
-                        for i, archive_part in enumerate(archive_parts, 1):
-                            async with page.expect_download(timeout=TIMEOUT_MILLIS * 2) as download_info:
-                                await archive_part.click()
-                                await handle_reauth(page)
-                            download_meta = await download_info.value
-                            for try_n in range(1, 4):
-                                try:
-                                    await download_meta.save_as(
-                                        target_archive_download_path.joinpath(
-                                            download_meta.suggested_filename
+                    print(
+                        f"going to download {len(archive_parts)} parts, {DOWNLOAD_CONCURRENCY=}"
+                    )
+                    with metrics.stage("plan") as stage:
+                        disk_plan = plan_disk_usage(
+                            await estimate_part_sizes(archive_parts, manifest),
+                            manifest,
+                            downloads_path,
+                            account.backup_path,
+                            account.index_path,
+                        )
+                        stage.update(
+                            {k: v for k, v in disk_plan.items() if k.endswith("_bytes")}
+                        )
+                    with metrics.stage("download") as download_stats:
+                        try:
+                            await download_archive_parts(
+                                page,
+                                account,
+                                archive_parts,
+                                target_archive_download_path,
+                                manifest,
+                                limits.download_slots,
+                                stats=download_stats,
+                                on_part_downloaded=(
+                                    lambda i: extraction_tasks.append(
+                                        asyncio.create_task(
+                                            extract_downloaded_part(
+                                                extraction_pool,
+                                                manifest,
+                                                i,
+                                                target_archive_download_path,
+                                                delete_part=disk_plan["delete_parts"],
+                                                workers=limits.extraction_workers,
+                                                bandwidth=limits.extraction_bandwidth,
+                                                known_members=known_members,
+                                            )
                                         )
                                     )
-                                    break
-                                except Error:
-                                    if try_n >= 3:
-                                        raise
-                                    print(f"retrying download {i} after {try_n}")
-
-                            await download_meta.delete()
-                            print(f"downloaded {i}/{len(archive_parts)} parts")
-                    except TimeoutError:
-                        if not await page.locator(f'div[role="dialog"]').is_hidden():
-                            await request_new_archive(page)
-                            raise EarlyReturn(
-                                "We need new backup, requested export and exiting"
+                                )
+                                if disk_plan["pipelined"]
+                                else None,
                             )
-                        else:
-                            raise
+                        except TimeoutError:
+                            if not await page.locator(f'div[role="dialog"]').is_hidden():
+                                await request_new_archive(page)
+                                raise EarlyReturn(
+                                    "We need new backup, requested export and exiting"
+                                )
+                            else:
+                                raise
                     state = await page.context.storage_state()
                     auth_json_path.write_text(state["encoded_value"])
                 except EarlyReturn as e:
                     state = await page.context.storage_state()
                     auth_json_path.write_text(state["encoded_value"])
                     print(e)
-                    return
+                    return str(e)
                 except Exception:
                     try:
+                        encoded_timestamp = encode_takeout_timestamp(datetime.datetime.now())
+                        capture.dump(downloads_path.joinpath(encoded_timestamp))
                         if page and not page.is_closed():
-                            now = datetime.datetime.now()
-                            encoded_timestamp = encode_takeout_timestamp(now)
                             downloads_path.joinpath(
                                 f"{encoded_timestamp}.url"
                             ).write_text(page.url)
@@ -244,82 +1665,187 @@ async def main():
                             await page.screenshot(
                                 path=downloads_path.joinpath(f"{encoded_timestamp}.jpg")
                             )
-                            if console:
-                                downloads_path.joinpath(
-                                    f"{encoded_timestamp}.console"
-                                ).write_text("\n".join(console))
-                            if network:
-                                downloads_path.joinpath(
-                                    f"{encoded_timestamp}.net"
-                                ).write_text("\n".join(network))
                     except Exception as e:
                         print(f"failed to collect diagnostic info with {e}, ignoring")
                     raise
 
-    print("closed browser")
+    print(f"closed browser, reauth steps: {dict(account.reauth_counter)}")
 
-    for f in target_archive_download_path.glob("*.zip"):
-        with zipfile.ZipFile(f, "r") as archive:
-            # unarchived_path = target_archive_download_path.joinpath(os.path.commonpath(archive.namelist()))
-            archive.extractall(target_archive_download_path)
-    print("unpacked archives")
+    with metrics.stage("extract") as stage:
+        extraction_started_at = time.monotonic()
+        extraction_stats = await asyncio.gather(*extraction_tasks)
+        extraction_stats += await asyncio.gather(
+            *[
+                extract_downloaded_part(
+                    extraction_pool,
+                    manifest,
+                    i,
+                    target_archive_download_path,
+                    delete_part=disk_plan["delete_parts"],
+                    workers=limits.extraction_workers,
+                    bandwidth=limits.extraction_bandwidth,
+                    known_members=known_members,
+                )
+                for i, part in manifest.parts()
+                if part["state"] == "downloaded"
+            ]
+        )
+        stage["parts"] += len(extraction_stats)
+        stage["part_seconds"] += sum(stats["seconds"] for stats in extraction_stats)
+        for key in ("bytes", "files", "skipped"):
+            stage[key] += sum(stats[key] for stats in extraction_stats)
+        stage["errors"] += sum(len(stats["errors"]) for stats in extraction_stats)
+    unpacked_bytes = sum(stats["bytes"] for stats in extraction_stats)
+    extraction_seconds = time.monotonic() - extraction_started_at
+    extraction_errors = [error for stats in extraction_stats for error in stats["errors"]]
+    if extraction_errors:
+        errors_path = downloads_path.joinpath(f"{target_archive_id}.extraction-errors.json")
+        errors_path.write_text(json.dumps(extraction_errors, indent=2, ensure_ascii=False))
+        raise ExtractionError(
+            f"{len(extraction_errors)} corrupt members in "
+            f"{len({error["part"] for error in extraction_errors})} parts, see {errors_path}. "
+            f"Affected parts are going to be downloaded again by the next run"
+        )
+    print(
+        f"unpacked archives: {len(extraction_stats)} parts, {format_size(unpacked_bytes)} "
+        f"in {extraction_seconds:.0f}s, {format_size(unpacked_bytes / max(extraction_seconds, 1e-3))}/s"
+    )
 
-    unpacked_root_dir = [item for item in target_archive_download_path.iterdir() if item.is_dir()][0]
-    renamed_folders = []
-    for root, dirs, files in unpacked_root_dir.walk():
-        for path in dirs:
-            folder_path = pathlib.Path(root.joinpath(path))
-            if m := re.match(text_labels["year.folder.template"], folder_path.stem):
-                new_path = folder_path.parent.joinpath(f"Photos from {m.group(1)}")
-                renamed_folders.append((folder_path, new_path))
-                folder_path.rename(new_path)
+    processed_photos_path = target_archive_download_path.joinpath("export")
+    unpacked_root_dir = [
+        item
+        for item in target_archive_download_path.iterdir()
+        if item.is_dir() and item != processed_photos_path
+    ][0]
+    processing_plan_path = target_archive_download_path.joinpath("process-plan.json")
+    if not manifest.has_stage("processed"):
+        wait_started_at = time.monotonic()
+        with metrics.stage("process") as stage:
+            async with limits.processing_lock:
+                stage["wait_seconds"] += time.monotonic() - wait_started_at
+                await asyncio.to_thread(
+                    process_takeout,
+                    unpacked_root_dir,
+                    processed_photos_path,
+                    processing_plan_path,
+                    stats=stage,
+                    skipped_media=[
+                        (str(target_archive_download_path.joinpath(name)), size)
+                        for name, size in read_part_members(target_archive_download_path, "skipped")
+                    ],
+                )
+        if PROCESSING_DRY_RUN:
+            print("dry run of processing is done, exiting")
+            return "dry run of processing"
+        manifest.complete_stage("processed")
+    print("processed archives")
+    if not manifest.has_stage("merged"):
+        with metrics.stage("merge") as stage:
+            merge_started_at = time.monotonic()
+            merge_stats = await asyncio.to_thread(
+                sync_to_backup,
+                processed_photos_path,
+                account.backup_path,
+                account.index_path,
+                blobs_dir=account.blobs_path if DEDUP_STORE else None,
+                files=json.loads(processing_plan_path.read_text())["outputs"],
+                bandwidth=limits.merge_bandwidth,
+            )
+            print(
+                f"merged into {account.backup_path}: {merge_stats["added"]} added, "
+                f"{merge_stats["updated"]} updated, {merge_stats["skipped"]} skipped, "
+                f"{merge_stats["deduplicated"]} deduplicated, "
+                f"{format_size(merge_stats["bytes"])} written in {time.monotonic() - merge_started_at:.0f}s"
+            )
+            stage.update(merge_stats)
+            await asyncio.to_thread(
+                record_backed_up_members,
+                account.index_path,
+                read_part_members(target_archive_download_path, "unpacked"),
+            )
+        for i, _ in manifest.parts():
+            manifest.update_part(i, state="merged")
+        manifest.complete_stage("merged")
+    shutil.rmtree(target_archive_download_path)
+    account.timestamp_path.write_text(encode_takeout_timestamp(target_archive_timestamp))
+    manifest.path.unlink()
+    print(f"successfully backed up up to {target_archive_timestamp}")
+    return None
 
-    print(f"renamed folders: {renamed_folders}")
 
-    processed_photos_path = target_archive_download_path.joinpath("export")
+async def run_account(account: BackupAccount, limits: SharedLimits):
+    account_name.set(account.name)
+    metrics = RunMetrics(account)
+    started_at = time.monotonic()
     try:
-        subprocess.run(
-            [
-                "/app/utils/gpth",
-                "--copy",
-                "-i",
-                unpacked_root_dir,
-                "-o",
-                processed_photos_path,
-                "--albums",
-                "duplicate-copy",
-                "--no-divide-to-dates",
-            ],
-            text=True,
-            capture_output=True,
-            check=True,
-        )
-    except subprocess.CalledProcessError as e:
-        print(f"Stderr: {e.stderr}", file=sys.stderr)
-        print(f"Stdout: {e.stdout}")
-        raise e
+        metrics.detail = await backup_account(account, limits, metrics)
+        metrics.status = "skipped" if metrics.detail else "backed up"
+    except Exception as e:
+        metrics.status, metrics.error = "failed", e
+    metrics.seconds = time.monotonic() - started_at
+    try:
+        print(f"run report: {metrics.save(account.reports_path)}")
+    except OSError as e:
+        print(f"failed to save run report with {e!r}, ignoring")
+    return metrics
+
 
-    all_photos_path = processed_photos_path.joinpath(
-        os.getenv("GPTH_DEFAULT_FOLDER_NAME", "ALL_PHOTOS")
+async def main():
+    if DOWNLOAD_MODE not in DOWNLOAD_MODES:
+        raise Exception(f"DOWNLOAD_MODE must be one of {DOWNLOAD_MODES}, got {DOWNLOAD_MODE}")
+    if DOWNLOAD_MODE == "shared" and not BROWSER_DOWNLOADS_PATH:
+        raise Exception("BROWSER_DOWNLOADS_PATH is required by DOWNLOAD_MODE=shared")
+    accounts = load_accounts()
+    total_download_concurrency = max(1, TOTAL_DOWNLOAD_CONCURRENCY or DOWNLOAD_CONCURRENCY * len(accounts))
+    print(
+        f"{TIMEOUT_MILLIS=}, {PIPELINED_EXTRACTION=}, {DELETE_EXTRACTED_PARTS=}, "
+        f"{len(accounts)} accounts, {DOWNLOAD_CONCURRENCY=}, {total_download_concurrency=}, {EXTRACTION_WORKERS=}, "
+        f"disk bandwidth {f"{format_size(DISK_BANDWIDTH)}/s" if DISK_BANDWIDTH else "unlimited"}"
     )
-    for f in all_photos_path.iterdir():
-        shutil.move(f, processed_photos_path.joinpath(f.name))
-    all_photos_path.rmdir()
-    print("processed archives")
-    shutil.copytree(processed_photos_path, backup_path, dirs_exist_ok=True)
-    shutil.rmtree(target_archive_download_path)
-    timestamp_path.write_text(encode_takeout_timestamp(target_archive_timestamp))
-    print(f"successfully backed up up to {target_archive_timestamp}")
+    if len(accounts) > 1:
+        sys.stdout = AccountPrefixedOutput(sys.stdout)
+    limits = SharedLimits(total_download_concurrency, EXTRACTION_WORKERS, DISK_BANDWIDTH)
+    with limits.extraction_pool:
+        runs = await asyncio.gather(*[run_account(a, limits) for a in accounts])
+    if PROMETHEUS_TEXTFILE:
+        write_prometheus_textfile(pathlib.Path(PROMETHEUS_TEXTFILE), runs)
+    print("status report:")
+    for metrics in runs:
+        print(
+            f"  {metrics.account}: {metrics.status} in {metrics.seconds:.0f}s"
+            + (f" - {metrics.detail or metrics.error}" if metrics.detail or metrics.error else "")
+            + "".join(
+                f", {stage} {counters["seconds"]:.0f}s" for stage, counters in metrics.stages.items()
+            )
+        )
+    if errors := [metrics.error for metrics in runs if metrics.error]:
+        raise ExceptionGroup(f"{len(errors)} of {len(accounts)} accounts failed", errors)
 
 
 async def request_new_archive(page):
-    await page.goto("https://takeout.google.com/settings/takeout/custom/photos")
+    await page.goto(f"{TAKEOUT_BASEURL}settings/takeout/custom/photos")
     element_by_exact_text = page.get_by_text(f"{text_labels["proceed"]}")
     await element_by_exact_text.click()
     element_by_exact_text = page.get_by_text(f"{text_labels["create.export"]}")
     await element_by_exact_text.click()
 
 
+def file_sha256(path: pathlib.Path):
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(2**20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def format_size(val):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(val) < 1024:
+            return f"{val:.1f}{unit}"
+        val /= 1024
+    return f"{val:.1f}TiB"
+
+
 def parse_takeout_timestamp(val):
     return datetime.datetime.strptime(val, "%Y%m%dT%H%M%SZ")
 
@@ -329,4 +1855,8 @@ def encode_takeout_timestamp(val):
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if "gc" in sys.argv[1:]:
+        for gc_account in load_accounts():
+            collect_garbage(gc_account.backup_path, gc_account.index_path, gc_account.blobs_path)
+    else:
+        asyncio.run(main())
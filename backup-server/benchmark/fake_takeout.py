@@ -0,0 +1,130 @@
+import html
+import http.server
+import pathlib
+import threading
+import time
+import urllib.parse
+
+DOWNLOAD_CHUNK_SIZE = 2**20
+
+
+class FakeTakeout:
+    """Local stand-in of takeout pages backup.py goes through: manage page, archive pages,
+    report and part downloads, new export request.
+
+    archives is a list of {"id", "timestamp", "parts": [zip paths]}, newest first
+    """
+
+    def __init__(self, text_labels, archives, bandwidth=0):
+        self.text_labels = text_labels
+        self.archives = {archive["id"]: archive for archive in archives}
+        self.bandwidth = bandwidth
+        self.export_requests = 0
+        self.server = None
+
+    def start(self, host="127.0.0.1", port=0):
+        self.server = http.server.ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.server.server_port}/"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        takeout = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                if url.path == "/manage":
+                    self.send_page(takeout.manage_page())
+                elif url.path.startswith("/manage/archive/") and (
+                    archive := takeout.archives.get(url.path.rsplit("/", 1)[-1])
+                ):
+                    self.send_page(takeout.archive_page(archive))
+                elif url.path == "/takeout/download" and (
+                    archive := takeout.archives.get(query.get("j"))
+                ):
+                    if "report" in query:
+                        self.send_report(archive)
+                    else:
+                        self.send_part(archive["parts"][int(query["i"]) - 1])
+                elif url.path == "/settings/takeout/custom/photos":
+                    self.send_page(takeout.export_page())
+                elif url.path == "/export":
+                    takeout.export_requests += 1
+                    self.send_page("<p>export requested</p>")
+                else:
+                    self.send_error(404)
+
+            def send_page(self, body):
+                data = f"<!DOCTYPE html><html><body>{body}</body></html>".encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_attachment(self, filename, size):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/zip")
+                self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+
+            def send_report(self, archive):
+                data = b"report"
+                self.send_attachment(
+                    f"takeout-{archive["timestamp"]}-report.html", len(data)
+                )
+                self.wfile.write(data)
+
+            def send_part(self, part_path: pathlib.Path):
+                self.send_attachment(part_path.name, part_path.stat().st_size)
+                started_at = time.monotonic()
+                sent = 0
+                with part_path.open("rb") as part:
+                    while chunk := part.read(DOWNLOAD_CHUNK_SIZE):
+                        try:
+                            self.wfile.write(chunk)
+                        except (BrokenPipeError, ConnectionResetError):
+                            # report download is cancelled right away
+                            return
+                        sent += len(chunk)
+                        if takeout.bandwidth:
+                            delay = sent / takeout.bandwidth - (time.monotonic() - started_at)
+                            if delay > 0:
+                                time.sleep(delay)
+
+        return Handler
+
+    def manage_page(self):
+        return "".join(
+            f'<a href="manage/archive/{archive_id}"><p>{html.escape(self.text_labels["export.ready.label"])}</p></a>'
+            for archive_id in self.archives
+        )
+
+    def archive_page(self, archive):
+        report_label = html.escape(self.text_labels["report.download"])
+        links = [
+            f'<a aria-label="{report_label}" href="/takeout/download?j={archive["id"]}&report=1">{report_label}</a>'
+        ]
+        # sizes are shown the way takeout does, they are what backup.py plans disk usage by
+        links += [
+            f'<a href="/takeout/download?j={archive["id"]}&i={i}">'
+            f"{part_path.name} ({part_path.stat().st_size / 2**20:.1f} MB)</a>"
+            for i, part_path in enumerate(archive["parts"], 1)
+        ]
+        return "<br>".join(links)
+
+    def export_page(self):
+        return (
+            f'<button onclick="this.nextElementSibling.hidden=false">{html.escape(self.text_labels["proceed"])}</button>'
+            f'<a href="/export" hidden>{html.escape(self.text_labels["create.export"])}</a>'
+        )
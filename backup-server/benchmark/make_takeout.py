@@ -0,0 +1,113 @@
+import datetime
+import json
+import pathlib
+import random
+import re
+import sys
+import zipfile
+
+PHOTOS_FOLDER = "Takeout/Google Фото"
+EDITED_SUFFIX = "-изменено"
+
+
+def year_folder_name(template, year):
+    """Folder name matching year.folder.template regex"""
+    return re.sub(r"\(\\d\{4\}\)", str(year), template).replace("\\", "")
+
+
+def plan_takeout_entries(
+    media_count, media_size, albums, album_share, edited_share, years, year_template, rng
+):
+    """Entries of the takeout tree as (path, content) in the order google packs them.
+
+    Content is (size, seed) of media bytes, json or text. Album copies share the seed of their year media,
+    so they are byte-identical as in a real takeout
+    """
+    # non-media every real takeout has, it must not end up in the backup
+    entries = [("Takeout/archive_browser.html", "<html><body>archive browser</body></html>")]
+    year_media = []
+    first_year = datetime.datetime.now().year - years + 1
+    for n in range(media_count):
+        year = first_year + n % years
+        folder = f"{PHOTOS_FOLDER}/{year_folder_name(year_template, year)}"
+        name = f"IMG_{n:05d}.jpg"
+        media = (max(1, int(media_size * rng.uniform(0.5, 1.5))), rng.getrandbits(64))
+        taken_at = int(datetime.datetime(year, 1 + n % 12, 1 + n % 28).timestamp())
+        sidecar = {"title": name, "photoTakenTime": {"timestamp": str(taken_at)}}
+        entries.append((f"{folder}/{name}", media))
+        entries.append((f"{folder}/{name}.supplemental-metadata.json", sidecar))
+        if rng.random() < edited_share:
+            # same size, other content
+            edited = (media[0], rng.getrandbits(64))
+            entries.append((f"{folder}/IMG_{n:05d}{EDITED_SUFFIX}.jpg", edited))
+        year_media.append((name, media, sidecar))
+    for album in range(1, albums + 1):
+        folder = f"{PHOTOS_FOLDER}/Album {album}"
+        entries.append((f"{folder}/metadata.json", {"title": f"Album {album}"}))
+        for name, media, sidecar in rng.sample(year_media, int(len(year_media) * album_share)):
+            entries.append((f"{folder}/{name}", media))
+            entries.append((f"{folder}/{name}.supplemental-metadata.json", sidecar))
+        # media deleted from the library but kept in the album
+        for n in range(max(1, int(media_count * album_share / 10))):
+            name = f"ALBUM{album}_{n:04d}.jpg"
+            entries.append((f"{folder}/{name}", (media_size, rng.getrandbits(64))))
+    return entries
+
+
+def make_takeout(
+    target_path: pathlib.Path,
+    archive_timestamp: datetime.datetime,
+    parts=2,
+    media_count=200,
+    media_size=2**20,
+    albums=3,
+    album_share=0.2,
+    edited_share=0.05,
+    years=5,
+    year_template=r"Photos from (\d{4})",
+    seed=0,
+):
+    """Writes a synthetic takeout split into parts zips like google does, returns their paths.
+
+    Media content is random, so it is as incompressible as real photos
+    """
+    rng = random.Random(seed)
+    entries = plan_takeout_entries(
+        media_count, media_size, albums, album_share, edited_share, years, year_template, rng
+    )
+    total_size = sum(content[0] for _, content in entries if isinstance(content, tuple))
+    part_size = total_size / parts
+    target_path.mkdir(parents=True, exist_ok=True)
+    encoded_timestamp = archive_timestamp.strftime("%Y%m%dT%H%M%SZ")
+    part_paths = []
+    archive = None
+    written = 0
+    for path, content in entries:
+        if archive is None or (written >= part_size * len(part_paths) and len(part_paths) < parts):
+            if archive:
+                archive.close()
+            part_paths.append(
+                target_path.joinpath(f"takeout-{encoded_timestamp}-{len(part_paths) + 1:03d}.zip")
+            )
+            archive = zipfile.ZipFile(part_paths[-1], "w", zipfile.ZIP_STORED)
+        info = zipfile.ZipInfo(path, date_time=archive_timestamp.timetuple()[:6])
+        if isinstance(content, tuple):
+            size, media_seed = content
+            archive.writestr(info, random.Random(media_seed).randbytes(size))
+            written += size
+        elif isinstance(content, str):
+            archive.writestr(info, content)
+        else:
+            archive.writestr(info, json.dumps(content, ensure_ascii=False))
+    archive.close()
+    return part_paths
+
+
+if __name__ == "__main__":
+    for part_path in make_takeout(
+        pathlib.Path(sys.argv[1] if len(sys.argv) > 1 else "takeout"),
+        datetime.datetime.now().replace(microsecond=0),
+        parts=int(sys.argv[2]) if len(sys.argv) > 2 else 2,
+        media_count=int(sys.argv[3]) if len(sys.argv) > 3 else 200,
+    ):
+        print(f"{part_path}: {part_path.stat().st_size} bytes")
@@ -0,0 +1,290 @@
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import os
+import pathlib
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_takeout import FakeTakeout
+from make_takeout import make_takeout
+
+benchmark_path = pathlib.Path(__file__).resolve().parent
+backup_server_path = benchmark_path.parent
+browser_server_path = backup_server_path.parent.joinpath("browser-server")
+sys.path.insert(0, str(browser_server_path))
+
+from webs import KeyPair, generate_keys  # noqa: E402
+
+# bumped when make_takeout changes what it generates, so archives cached in the work dir are regenerated
+ARCHIVE_VERSION = 2
+STAGES = ["login", "probe", "plan", "download", "extract", "process", "merge"]
+# stages with the counter their throughput is measured by
+THROUGHPUT_STAGES = {"download": "bytes", "extract": "bytes", "merge": "bytes"}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"{process.args} exited with {process.returncode}")
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), 1):
+            return
+        time.sleep(0.2)
+    raise Exception(f"{process.args} didn't listen on {port} in {timeout}s")
+
+
+@contextlib.contextmanager
+def background_process(args, port, **kwargs):
+    # own process group, so children like the node driver of launch-server are stopped too
+    process = subprocess.Popen(args, start_new_session=True, **kwargs)
+    try:
+        wait_for_port(port, process)
+        yield process
+    finally:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def prepare_archive(work_path: pathlib.Path, args, year_template):
+    """Generates the synthetic archive once per set of parameters"""
+    archive_id = f"{args.parts}p-{args.media}m-{args.media_size}b-{args.albums}a-{args.seed}s-v{ARCHIVE_VERSION}"
+    archive_path = work_path.joinpath("archives", archive_id)
+    timestamp_path = archive_path.joinpath(".timestamp")
+    if not timestamp_path.exists():
+        shutil.rmtree(archive_path, ignore_errors=True)
+        archive_timestamp = datetime.datetime.now().replace(microsecond=0)
+        started_at = time.monotonic()
+        make_takeout(
+            archive_path,
+            archive_timestamp,
+            parts=args.parts,
+            media_count=args.media,
+            media_size=args.media_size,
+            albums=args.albums,
+            year_template=year_template,
+            seed=args.seed,
+        )
+        timestamp_path.write_text(archive_timestamp.strftime("%Y%m%dT%H%M%SZ"))
+        print(f"generated {archive_id} in {time.monotonic() - started_at:.0f}s")
+    return {
+        "id": archive_id,
+        "timestamp": timestamp_path.read_text(),
+        "parts": sorted(archive_path.glob("*.zip")),
+    }
+
+
+def prepare_run_dir(run_path: pathlib.Path, key_pair: KeyPair, keep_photos):
+    if not keep_photos:
+        shutil.rmtree(run_path, ignore_errors=True)
+    run_path.joinpath("photos").mkdir(parents=True, exist_ok=True)
+    run_path.joinpath("photos", ".timestamp").unlink(missing_ok=True)
+    # otherwise every run after the first one measures a probe cache hit
+    run_path.joinpath("photos", ".archive-timestamps.json").unlink(missing_ok=True)
+    shutil.rmtree(run_path.joinpath("downloads"), ignore_errors=True)
+    run_path.joinpath("downloads").mkdir()
+    for labels_source in backup_server_path.glob("keys_*.csv"):
+        shutil.copy(labels_source, run_path)
+    empty_state = json.dumps({"cookies": [], "origins": []})
+    run_path.joinpath(".auth_encoded").write_text(key_pair.encrypt(empty_state.encode()).hex())
+
+
+def run_backup(run_path: pathlib.Path, env):
+    started_at = time.monotonic()
+    result = subprocess.run(
+        [sys.executable, str(backup_server_path.joinpath("backup.py"))],
+        cwd=run_path,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    seconds = time.monotonic() - started_at
+    if result.returncode:
+        print(result.stdout)
+        raise Exception(f"backup run failed with {result.returncode}")
+    report_path = sorted(run_path.joinpath("downloads", "reports").glob("*.json"))[-1]
+    report = json.loads(report_path.read_text())
+    if report["status"] != "backed up":
+        print(result.stdout)
+        raise Exception(f"backup run ended with {report["status"]}: {report["detail"]}")
+    report["wall_seconds"] = seconds
+    return report
+
+
+def check_backup(photos_path: pathlib.Path):
+    """Backup must hold the synthetic media only, not the rest of the takeout like archive_browser.html"""
+    unexpected = [
+        path.relative_to(photos_path)
+        for path in photos_path.rglob("*")
+        if path.is_file()
+        and not any(part.startswith(".") for part in path.relative_to(photos_path).parts)
+        and path.suffix != ".jpg"
+    ]
+    if unexpected:
+        raise Exception(f"non-media files in {photos_path}: {unexpected[:10]}")
+
+
+def summarize(reports):
+    summary = {"wall_seconds": statistics.median(r["wall_seconds"] for r in reports)}
+    for stage in STAGES:
+        seconds = [r["stages"].get(stage, {}).get("seconds", 0) for r in reports]
+        summary[f"{stage}_seconds"] = statistics.median(seconds)
+        if counter := THROUGHPUT_STAGES.get(stage):
+            summary[f"{stage}_mib_per_second"] = statistics.median(
+                r["stages"].get(stage, {}).get(counter, 0) / 2**20 / max(s, 1e-3)
+                for r, s in zip(reports, seconds)
+            )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs backup.py end to end against a local fake takeout with a synthetic archive. "
+        "Backup tuning env vars (DOWNLOAD_CONCURRENCY, EXTRACTION_WORKERS, ...) are passed through"
+    )
+    parser.add_argument("--parts", type=int, default=2)
+    parser.add_argument("--media", type=int, default=500, help="media count in year folders")
+    parser.add_argument("--media-size", type=int, default=2**20, help="average media size in bytes")
+    parser.add_argument("--albums", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--bandwidth-mb", type=float, default=0, help="per download MiB/s cap of the fake server"
+    )
+    parser.add_argument(
+        "--keep-photos",
+        action="store_true",
+        help="keep photos between runs to measure merging into an existing backup",
+    )
+    parser.add_argument(
+        "--work-dir", type=pathlib.Path, default=pathlib.Path(tempfile.gettempdir(), "takeout-benchmark")
+    )
+    parser.add_argument("--label", default="", help="name of the compared variant in results")
+    parser.add_argument(
+        "--executable-path", help="chromium binary to launch instead of the one playwright installs"
+    )
+    args = parser.parse_args()
+
+    lang = os.getenv("GOOGLE_LANG", "RU")
+    with backup_server_path.joinpath(f"keys_{lang}.csv").open() as labels_data:
+        text_labels = {row[0]: row[1] for row in csv.reader(labels_data, delimiter="=")}
+    work_path = args.work_dir.resolve()
+    archive = prepare_archive(work_path, args, text_labels["year.folder.template"])
+    archive_size = sum(part.stat().st_size for part in archive["parts"])
+    print(f"archive {archive["id"]}: {len(archive["parts"])} parts, {archive_size / 2**20:.0f}MiB")
+
+    secret_key, public_key = generate_keys()
+    key_pair = KeyPair(secret_key, public_key)
+    takeout = FakeTakeout(text_labels, [archive], bandwidth=args.bandwidth_mb * 2**20)
+    takeout_url = takeout.start()
+    browser_port = free_port()
+    proxy_port = free_port()
+    launch_config_path = work_path.joinpath("launch-params.json")
+    launch_config = {
+        "port": browser_port,
+        "wsPath": "/srv",
+        "headless": True,
+        "chromiumSandbox": False,
+        "downloadsPath": str(work_path.joinpath("browser-downloads")),
+    }
+    if args.executable_path:
+        launch_config["executablePath"] = args.executable_path
+    launch_config_path.write_text(json.dumps(launch_config))
+    reports = []
+    try:
+        with (
+            background_process(
+                [sys.executable, "-m", "playwright", "launch-server", "--browser=chromium",
+                 "--config", str(launch_config_path)],
+                browser_port,
+                stdout=subprocess.DEVNULL,
+            ),
+            background_process(
+                [sys.executable, str(browser_server_path.joinpath("webs.py"))],
+                proxy_port,
+                env=os.environ
+                | {
+                    "BROWSER_URL": f"ws://127.0.0.1:{browser_port}/srv",
+                    "PROXY_LISTEN_PORT": str(proxy_port),
+                    "SK": secret_key,
+                    "PK": public_key,
+                },
+                stdout=subprocess.DEVNULL,
+            ),
+        ):
+            env = os.environ | {
+                "TAKEOUT_BASEURL": takeout_url,
+                "BROWSER_SERVER_URL": f"ws://127.0.0.1:{proxy_port}/srv",
+                "ENCODED_PASS": key_pair.encrypt(b"benchmark").hex(),
+                "GOOGLE_LANG": lang,
+                "PYTHONUNBUFFERED": "1",
+            }
+            env.pop("ACCOUNTS_CONFIG", None)
+            run_path = work_path.joinpath("run")
+            for run in range(1, args.runs + 1):
+                prepare_run_dir(run_path, key_pair, args.keep_photos)
+                report = run_backup(run_path, env)
+                check_backup(run_path.joinpath("photos"))
+                reports.append(report)
+                print(
+                    f"run {run}/{args.runs}: {report["wall_seconds"]:.1f}s, "
+                    + ", ".join(
+                        f"{stage} {report["stages"][stage]["seconds"]:.1f}s"
+                        for stage in STAGES
+                        if stage in report["stages"]
+                    )
+                )
+    finally:
+        takeout.stop()
+
+    summary = summarize(reports)
+    results_path = work_path.joinpath("results")
+    results_path.mkdir(exist_ok=True)
+    result_path = results_path.joinpath(
+        f"{datetime.datetime.now().strftime("%Y%m%dT%H%M%S")}{f"-{args.label}" if args.label else ""}.json"
+    )
+    result_path.write_text(
+        json.dumps(
+            {
+                "label": args.label,
+                "params": {k: str(v) for k, v in vars(args).items()},
+                "archive_bytes": archive_size,
+                "env": {
+                    k: v
+                    for k, v in os.environ.items()
+                    if k.startswith(("DOWNLOAD_", "EXTRACTION_", "PIPELINED_", "DELETE_", "PROCESSING_",
+                                     "DEDUP_", "DISK_", "TOTAL_"))
+                },
+                "summary": summary,
+                "reports": reports,
+            },
+            indent=2,
+            ensure_ascii=False,
+        )
+    )
+    print(f"median of {len(reports)} runs, results in {result_path}:")
+    for key, value in summary.items():
+        print(f"  {key}: {value:.2f}")
+
+
+if __name__ == "__main__":
+    main()
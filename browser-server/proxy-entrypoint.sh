@@ -1,3 +1,3 @@
 #!/bin/sh
-pip install --root-user-action=ignore --disable-pip-version-check -q eciespy eth-keys coincurve websockets
+pip install --root-user-action=ignore --disable-pip-version-check -q eciespy eth-keys coincurve "websockets>=14"
 python $@
\ No newline at end of file
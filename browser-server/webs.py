@@ -1,8 +1,12 @@
 import asyncio
+import collections
+import contextlib
+import functools
 import json
 import os
 import re
 import sys
+import time
 
 import coincurve
 import eth_keys
@@ -10,6 +14,26 @@ import websockets
 from ecies import decrypt, encrypt
 from websockets import ServerConnection
 
+MAX_MESSAGE_SIZE = (2**30) * 4
+LOG_CLIENT_MESSAGES = bool(os.getenv("LOG_CLIENT_MESSAGES"))
+LOG_BACKEND_MESSAGES = bool(os.getenv("LOG_BACKEND_MESSAGES"))
+# protocol frames start with id, guid and method, so they are found in raw bytes without decoding the whole frame
+FRAME_HEAD_SIZE = 256
+FRAME_METHOD_PATTERN = re.compile(b'"method":"([A-Za-z_]+)"')
+FRAME_ID_PATTERN = re.compile(b'\\{"id":(\\d+),')
+# replies to these requests carry storage state to be encrypted before leaving the proxy
+STORAGE_STATE_METHODS = {"storageState"}
+MAX_PENDING_REPLIES = 64
+QUEUE_SIZE = int(os.getenv("PROXY_QUEUE_SIZE", "16"))
+CONNECTION_MEMORY_LIMIT = int(os.getenv("PROXY_CONNECTION_MEMORY_MB", "256")) * 2**20
+STATS_INTERVAL_SECONDS = float(os.getenv("PROXY_STATS_INTERVAL_SECONDS", "60"))
+BACKEND_MAX_CONNECTIONS = int(os.getenv("BACKEND_MAX_CONNECTIONS", "4"))
+BACKEND_WARM_CONNECTIONS = int(os.getenv("BACKEND_WARM_CONNECTIONS", "1"))
+DECRYPT_CACHE_SIZE = int(os.getenv("DECRYPT_CACHE_SIZE", "16"))
+DECRYPT_CACHE_TTL_SECONDS = float(os.getenv("DECRYPT_CACHE_TTL_SECONDS", "600"))
+
+not_shutdown = [1]
+
 
 def generate_keys():
     return (
@@ -18,86 +42,369 @@ def generate_keys():
     )[-1]
 
 
-secret_key = os.getenv("SK")
-public_key = os.getenv("PK")
-if not secret_key or not public_key:
-    secret_key, public_key = generate_keys()
-backend_uri = os.getenv("BROWSER_URL")
-MAX_MESSAGE_SIZE = (2**30) * 4
+class PlaintextCache:
+    """LRU of decrypted values by ciphertext, plaintexts are zeroed once evicted or expired"""
 
-not_shutdown = [1]
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict()
+
+    def get(self, ciphertext):
+        self.evict_expired()
+        if not (entry := self.entries.get(ciphertext)):
+            return None
+        self.entries.move_to_end(ciphertext)
+        return bytes(entry[1])
+
+    def put(self, ciphertext, plaintext):
+        self.evict_expired()
+        if ciphertext in self.entries:
+            self.evict(ciphertext)
+        self.entries[ciphertext] = (time.monotonic() + self.ttl_seconds, bytearray(plaintext))
+        while len(self.entries) > self.max_size:
+            self.evict(next(iter(self.entries)))
+
+    def evict_expired(self):
+        now = time.monotonic()
+        for ciphertext in [c for c, (expires_at, _) in self.entries.items() if now > expires_at]:
+            self.evict(ciphertext)
+
+    def evict(self, ciphertext):
+        _, plaintext = self.entries.pop(ciphertext)
+        plaintext[:] = bytes(len(plaintext))
+
+
+class KeyPair:
+    """Key material parsed once instead of on every ecies call, with decrypted values cached"""
+
+    def __init__(self, secret_key_hex, public_key_hex):
+        self.public_key_hex = public_key_hex
+        self.secret_key = bytes.fromhex(secret_key_hex.removeprefix("0x"))
+        public_key = bytes.fromhex(public_key_hex.removeprefix("0x"))
+        # eth public keys come without the uncompressed point prefix
+        self.public_key = b"\x04" + public_key if len(public_key) == 64 else public_key
+        self.plaintexts = PlaintextCache(DECRYPT_CACHE_SIZE, DECRYPT_CACHE_TTL_SECONDS)
+
+    def decrypt(self, ciphertext_hex):
+        if (plaintext := self.plaintexts.get(ciphertext_hex)) is None:
+            plaintext = decrypt(self.secret_key, bytes.fromhex(ciphertext_hex))
+            self.plaintexts.put(ciphertext_hex, plaintext)
+        return plaintext
+
+    def encrypt(self, data):
+        return encrypt(self.public_key, data)
 
 
-async def proxy_websocket(client_websocket: ServerConnection):
-    try:
-        async with websockets.connect(
-            backend_uri, max_size=MAX_MESSAGE_SIZE
-        ) as backend_websocket:
-            print(f"connected to {backend_uri=}")
+class Backend:
+    """Browser server endpoint with capped concurrent connections and pre-opened spare ones.
 
-            async def client_to_backend():
-                async for message in client_websocket:
-                    await backend_websocket.send(await process_client_message(message))
+    A protocol session can't be shared, so a warm connection serves one client and is replaced
+    """
 
-            async def backend_to_client():
-                async for message in backend_websocket:
-                    await client_websocket.send(await process_backend_message(message))
+    def __init__(self, uri, max_connections, warm_connections):
+        self.uri = uri
+        self.slots = asyncio.Semaphore(max_connections)
+        self.warm_connections = warm_connections
+        self.warm = []
+        self.refill_task = None
 
-            await asyncio.gather(client_to_backend(), backend_to_client())
+    def refill(self):
+        if self.warm_connections and (not self.refill_task or self.refill_task.done()):
+            self.refill_task = asyncio.create_task(self.open_warm_connections())
 
-    except websockets.exceptions.ConnectionClosedOK:
-        print("Backend connection closed normally.")
+    async def open_warm_connections(self):
+        while len(self.warm) < self.warm_connections:
+            try:
+                self.warm.append(await websockets.connect(self.uri, max_size=MAX_MESSAGE_SIZE, compression=None))
+            except (OSError, websockets.exceptions.WebSocketException) as e:
+                print(f"failed to open warm connection to {self.uri}: {e!r}")
+                return
 
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        async with self.slots:
+            backend_websocket = None
+            while self.warm and not backend_websocket:
+                candidate = self.warm.pop()
+                if candidate.state is websockets.protocol.State.OPEN:
+                    backend_websocket = candidate
+                else:
+                    await candidate.close()
+            if not backend_websocket:
+                backend_websocket = await websockets.connect(self.uri, max_size=MAX_MESSAGE_SIZE, compression=None)
+            self.refill()
+            async with backend_websocket:
+                yield backend_websocket
+
+
+class Account:
+    def __init__(self, name, key_pair: KeyPair, backend: Backend):
+        self.name = name
+        self.key_pair = key_pair
+        self.backend = backend
+
+
+def load_accounts():
+    """Default account from SK/PK/BROWSER_URL plus ones listed in ACCOUNTS with SK_{NAME}/PK_{NAME}/BROWSER_URL_{NAME}"""
+    backends = {}
+
+    def backend_for(uri):
+        return backends.setdefault(
+            uri, Backend(uri, BACKEND_MAX_CONNECTIONS, BACKEND_WARM_CONNECTIONS)
+        )
+
+    secret_key, public_key = os.getenv("SK"), os.getenv("PK")
+    if not secret_key or not public_key:
+        secret_key, public_key = generate_keys()
+    default_uri = os.getenv("BROWSER_URL")
+    loaded = {None: Account(None, KeyPair(secret_key, public_key), backend_for(default_uri))}
+    for name in filter(None, os.getenv("ACCOUNTS", "").split(",")):
+        env_name = re.sub("\\W", "_", name).upper()
+        secret_key, public_key = os.getenv(f"SK_{env_name}"), os.getenv(f"PK_{env_name}")
+        if not secret_key or not public_key:
+            secret_key, public_key = generate_keys()
+        loaded[name] = Account(
+            name,
+            KeyPair(secret_key, public_key),
+            backend_for(os.getenv(f"BROWSER_URL_{env_name}", default_uri)),
+        )
+    return loaded, backends
+
+
+def route_account(accounts, path):
+    """/srv/{account} selects an account, any other path is served by the default one"""
+    parts = path.split("?", 1)[0].strip("/").split("/")
+    if len(parts) == 2 and parts[0] == "srv":
+        return accounts.get(parts[1])
+    return accounts[None]
+
+
+class MemoryBudget:
+    """Bytes of messages a connection holds in its queues, a message over the limit is let through alone"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.used == 0 or self.used + size <= self.limit
+            )
+            self.used += size
 
-async def process_client_message(message):
+    async def release(self, size):
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class PumpStats:
+    def __init__(self, name, queue):
+        self.name = name
+        self.queue = queue
+        self.messages = 0
+        self.bytes = 0
+        self.max_queue_depth = 0
+
+    def report(self, elapsed):
+        return (
+            f"{self.name}: {self.messages} messages, {format_size(self.bytes)}, "
+            f"{format_size(self.bytes / max(elapsed, 1e-3))}/s, "
+            f"queue {self.queue.qsize()}/{self.queue.maxsize} (max {self.max_queue_depth})"
+        )
+
+
+async def pump(source, target, process, stats: PumpStats, budget: MemoryBudget):
+    """Reads messages into a bounded queue while they are sent out, so neither side is read faster than the other is written.
+
+    Messages are read as raw bytes and sent as text frames, the only ones playwright protocol has,
+    so frames process returns unchanged are never decoded from utf-8 and encoded back
+    """
+
+    async def read():
+        while True:
+            try:
+                message = await source.recv(decode=False)
+            except websockets.exceptions.ConnectionClosedOK:
+                break
+            message = await process(message)
+            await budget.acquire(len(message))
+            await stats.queue.put(message)
+            stats.max_queue_depth = max(stats.max_queue_depth, stats.queue.qsize())
+        await stats.queue.put(None)
+
+    async def write():
+        while (message := await stats.queue.get()) is not None:
+            try:
+                await target.send(message, text=True)
+            finally:
+                await budget.release(len(message))
+            stats.messages += 1
+            stats.bytes += len(message)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(read())
+        tg.create_task(write())
+
+
+async def report_stats(connection_id, pumps, started_at):
+    while True:
+        await asyncio.sleep(STATS_INTERVAL_SECONDS)
+        elapsed = asyncio.get_running_loop().time() - started_at
+        print(f"connection {connection_id}: " + "; ".join(p.report(elapsed) for p in pumps))
+
+
+async def proxy_websocket(client_websocket: ServerConnection, accounts):
+    connection_id = client_websocket.id
+    if not (account := route_account(accounts, client_websocket.request.path)):
+        print(f"unknown account requested by {client_websocket.request.path=}")
+        await client_websocket.close(code=1008, reason="unknown account")
+        return
+    key_pair = account.key_pair
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+    async with account.backend.connection() as backend_websocket:
+        print(f"connected to {account.backend.uri=} for {account.name=}, {connection_id=}")
+        pending_replies = collections.OrderedDict()
+        budget = MemoryBudget(CONNECTION_MEMORY_LIMIT)
+        client_stats = PumpStats("client->backend", asyncio.Queue(QUEUE_SIZE))
+        backend_stats = PumpStats("backend->client", asyncio.Queue(QUEUE_SIZE))
+
+        pumps = [
+            asyncio.create_task(
+                pump(
+                    client_websocket,
+                    backend_websocket,
+                    lambda m: process_client_message(m, pending_replies, key_pair),
+                    client_stats,
+                    budget,
+                )
+            ),
+            asyncio.create_task(
+                pump(
+                    backend_websocket,
+                    client_websocket,
+                    lambda m: process_backend_message(m, pending_replies, key_pair),
+                    backend_stats,
+                    budget,
+                )
+            ),
+        ]
+        reporter = asyncio.create_task(
+            report_stats(connection_id, [client_stats, backend_stats], started_at)
+        )
+        # once either side is done or failed, the peer pump has nothing to talk to
+        done, pending = await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+        for task in [*pending, reporter]:
+            task.cancel()
+        await asyncio.gather(*pending, reporter, return_exceptions=True)
+        await client_websocket.close()
+        for task in done:
+            if (error := task.exception()) and not all(
+                isinstance(e, websockets.exceptions.ConnectionClosedOK)
+                for e in getattr(error, "exceptions", [error])
+            ):
+                print(f"connection {connection_id} failed: {error!r}")
+    elapsed = loop.time() - started_at
+    print(
+        f"connection {connection_id} closed after {elapsed:.0f}s: "
+        f"{client_stats.report(elapsed)}; {backend_stats.report(elapsed)}"
+    )
+
+
+def frame_method(message):
+    if m := FRAME_METHOD_PATTERN.search(message, 0, FRAME_HEAD_SIZE):
+        return m.group(1).decode()
+    return None
+
+
+def frame_id(message):
+    if m := FRAME_ID_PATTERN.match(message):
+        return int(m.group(1))
+    return None
+
+
+async def process_client_message(message: bytes, pending_replies, key_pair: KeyPair):
+    method = frame_method(message)
     modified_message = message
-    if encrypted_ := re.search('"input\\[type=password]","value":("[^"]+")', message):
+    if method in STORAGE_STATE_METHODS and (request_id := frame_id(message)) is not None:
+        pending_replies[request_id] = method
+        if len(pending_replies) > MAX_PENDING_REPLIES:
+            pending_replies.popitem(last=False)
+    elif method == "fill" and (
+        encrypted_ := re.search(b'"input\\[type=password]","value":("[^"]+")', message)
+    ):
         try:
-            val = decrypt(secret_key, bytes.fromhex(encrypted_.group(1).strip('"')))
+            val = key_pair.decrypt(encrypted_.group(1).strip(b'"').decode())
             modified_message = re.sub(
                 '("input\\[type=password]","value"):("[^"]+")',
                 f'\\1:"{val.decode()}"',
-                message,
+                message.decode(),
             )
         except ValueError:
             print(f"failed to parse encrypted {message=}")
-    elif re.search('"method":"newContext",.+"storageState":', message):
+    elif method == "newContext" and b'"storageState":' in message:
         message_dict = json.loads(message)
         encoded_state = message_dict["params"]["storageState"]["encoded_value"]
-        val = decrypt(secret_key, bytes.fromhex(encoded_state))
+        val = key_pair.decrypt(encoded_state)
         message_dict["params"]["storageState"] = json.loads(val)
         modified_message = json.dumps(message_dict)
 
-    if os.getenv("LOG_CLIENT_MESSAGES"):
-        print(f"from client: {modified_message=}")
+    if LOG_CLIENT_MESSAGES:
+        print(f"from client: {as_text(modified_message)}")
     return modified_message
 
 
-async def process_backend_message(message):
+async def process_backend_message(message: bytes, pending_replies, key_pair: KeyPair):
     modified_message = message
-    if '"result":{"cookies":' in message:
+    if pending_replies and pending_replies.pop(frame_id(message), None):
         message_dict = json.loads(message)
         if set(message_dict.get("result", {}).keys()) == set(["cookies", "origins"]):
             state = json.dumps(message_dict["result"])
             message_dict["result"] = {
-                "encoded_value": encrypt(public_key, state.encode()).hex()
+                "encoded_value": key_pair.encrypt(state.encode()).hex()
             }
-        modified_message = json.dumps(message_dict)
-    if os.getenv("LOG_BACKEND_MESSAGES"):
-        print(f"from backend: {modified_message=}")
+            modified_message = json.dumps(message_dict)
+    if LOG_BACKEND_MESSAGES:
+        print(f"from backend: {as_text(modified_message)}")
     return modified_message
 
 
+def as_text(message):
+    return message.decode(errors="replace") if isinstance(message, bytes) else message
+
+
+def format_size(val):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(val) < 1024:
+            return f"{val:.1f}{unit}"
+        val /= 1024
+    return f"{val:.1f}TiB"
+
+
 async def main():
     port = int(os.getenv("PROXY_LISTEN_PORT", "8080"))
+    accounts, backends = load_accounts()
 
     async with websockets.serve(
-        proxy_websocket, "0.0.0.0", port, max_size=MAX_MESSAGE_SIZE
+        functools.partial(proxy_websocket, accounts=accounts),
+        "0.0.0.0",
+        port,
+        max_size=MAX_MESSAGE_SIZE,
+        # frames are mostly base64 archive chunks, deflating them costs more cpu than it saves
+        compression=None,
     ) as server:
         print(f"started at {port=}")
-        print(
-            f"Encode backup params with public key: https://dzharikhin.github.io/ecies/?pk={public_key}"
-        )
+        for backend in backends.values():
+            backend.refill()
+        for account in accounts.values():
+            target = f" of {account.name} at /srv/{account.name}" if account.name else ""
+            print(
+                f"Encode backup params{target} with public key: https://dzharikhin.github.io/ecies/?pk={account.key_pair.public_key_hex}"
+            )
         await server.serve_forever()
 
 